@@ -23,3 +23,9 @@ application = ProtocolTypeRouter({
         )
     ),
 })
+
+# Start the story generation workers alongside the web server, unless they run as separate processes
+from django.conf import settings
+if settings.STORY_WORKERS_IN_PROCESS:
+    from api.tasks import scheduler
+    scheduler.start()
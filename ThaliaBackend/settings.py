@@ -169,6 +169,25 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Generated story images and audio are kept out of MEDIA_ROOT so they are not served publicly
+STORY_MEDIA_ROOT = os.environ.get('STORY_MEDIA_ROOT', os.path.join(BASE_DIR, 'story_media'))
+
+# Any Django storage backend can be configured for 'story_media', e.g. an object storage
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    'story_media': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+        'OPTIONS': {
+            'location': STORY_MEDIA_ROOT,
+        },
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -186,14 +205,55 @@ DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', EMAIL_HOST_USER)
 # ASGI application
 ASGI_APPLICATION = 'ThaliaBackend.asgi.application'
 
-# Configure channel layers
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',  # For development
-        # For production, use Redis:
-        # 'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        # 'CONFIG': {
-        #     "hosts": [('127.0.0.1', 6379)],
-        # },
-    },
+# Redis shared by all web and worker processes, e.g. redis://localhost:6379/0
+REDIS_URL = os.environ.get('REDIS_URL', '')
+
+# Configure channel layers and the cache
+if REDIS_URL:
+    # Job notifications published by any process reach the clients connected to every other one
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        },
+    }
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    # For development, only works when the workers run inside the web process
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Default and maximum number of items in a page of a story or job listing
+LIST_PAGE_SIZE = 20
+LIST_MAX_PAGE_SIZE = 100
+
+# Maximum size in bytes of a voice sample uploaded to the TTS backend
+TTS_UPLOAD_MAX_SIZE = int(os.environ.get('TTS_UPLOAD_MAX_SIZE', 50 * 1024 * 1024))
+# Seconds the list of a user's voice samples from the TTS backend is cached, 0 to disable the cache
+TTS_AUDIO_LIST_CACHE_TTL = int(os.environ.get('TTS_AUDIO_LIST_CACHE_TTL', 300))
+
+# Run the story generation workers inside the web process. Turn off when they run as
+# separate processes with `manage.py run_story_workers`, which needs REDIS_URL
+STORY_WORKERS_IN_PROCESS = os.environ.get('STORY_WORKERS_IN_PROCESS', 'True') == 'True'
+# Story generation workers, every pipeline stage has its own worker count
+STORY_STAGE_WORKERS = {
+    'generating_story': int(os.environ.get('STORY_TEXT_WORKERS', 2)),
+    'generating_image': int(os.environ.get('STORY_IMAGE_WORKERS', 1)),
+    'generating_audio': int(os.environ.get('STORY_AUDIO_WORKERS', 1)),
 }
+# Jobs that may wait between two stages before the previous stage stops taking new work
+STORY_STAGE_QUEUE_SIZE = int(os.environ.get('STORY_STAGE_QUEUE_SIZE', 4))
+STORY_WORKER_POLL_INTERVAL = float(os.environ.get('STORY_WORKER_POLL_INTERVAL', 5))
+STORY_WORKER_DRAIN_TIMEOUT = float(os.environ.get('STORY_WORKER_DRAIN_TIMEOUT', 600))
+# Seconds a worker holds a job without renewing it, after that another worker takes the job over
+STORY_JOB_LEASE_DURATION = float(os.environ.get('STORY_JOB_LEASE_DURATION', 60))
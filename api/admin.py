@@ -3,6 +3,8 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 from django.utils.safestring import mark_safe
 from .models import StoryJob, Story, StoryTheme, StoryCharacter, StoryCharacterSource
+from .services import JobService
+from .tasks import retry_job
 
 admin.site.site_header = "Thalia Administration"
 admin.site.site_title = "Thalia Admin Portal"
@@ -10,10 +12,12 @@ admin.site.site_title = "Thalia Admin Portal"
 # Register your models here.
 @admin.register(StoryJob)
 class StoryJobAdmin(admin.ModelAdmin):
-    list_display = ('story__title', 'get_user', 'status', 'position', 'created_at', 'updated_at')
+    list_display = ('story__title', 'get_user', 'status', 'get_queue_position', 'created_at', 'updated_at')
+    list_select_related = ('story', 'story__user')
     list_filter = ('status', 'created_at')
     search_fields = ('story__title', 'story__user_description', 'story__user__username',)
-    readonly_fields = ('created_at', 'updated_at', 'get_story_title', 'get_story_description', 'get_user')
+    readonly_fields = ('created_at', 'updated_at', 'get_story_title', 'get_story_description', 'get_user', 'get_queue_position', 'checkpoint')
+    actions = ('retry_failed_jobs',)
     fieldsets = (
         (None, {
             'fields': ('story',)
@@ -22,7 +26,7 @@ class StoryJobAdmin(admin.ModelAdmin):
             'fields': ('get_story_title', 'get_story_description', 'get_user')
         }),
         ('Status Information', {
-            'fields': ('status', 'position', 'result'),
+            'fields': ('status', 'get_queue_position', 'result', 'checkpoint'),
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
@@ -44,6 +48,20 @@ class StoryJobAdmin(admin.ModelAdmin):
     get_user.short_description = 'User'
     get_user.admin_order_field = 'story__user__username'
 
+    def get_queryset(self, request):
+        # The queue positions of the listed jobs are counted in the list query itself
+        return JobService.with_queue_position(super().get_queryset(request))
+
+    def get_queue_position(self, obj):
+        return obj.queue_position
+    get_queue_position.short_description = 'Position'
+    get_queue_position.admin_order_field = 'queue_position'
+
+    @admin.action(description='Retry the selected failed jobs from their checkpoint')
+    def retry_failed_jobs(self, request, queryset):
+        retried = sum(retry_job(job) for job in queryset.filter(status='failed').select_related('story'))
+        self.message_user(request, f"{retried} job(s) queued again")
+
 @admin.register(Story)
 class StoryAdmin(admin.ModelAdmin):
     list_display = ('title', 'user', 'created_at')
@@ -3,9 +3,8 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
 
-from api.models import StoryJob
 from .services import JobService
-from .utils import serialize_job
+from .utils import paginate_newest_first, serialize_job
 
 class JobConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -42,46 +41,82 @@ class JobConsumer(AsyncWebsocketConsumer):
             # Check if we should filter for favorites only
             favorites_only = data.get('favorites_only', False)
             
-            # Fetch jobs for the user, potentially filtered by favorites
-            jobs = await self.get_user_jobs(favorites_only)
+            # Fetch a page of jobs for the user, potentially filtered by favorites
+            try:
+                seq, jobs, next_cursor = await self.get_user_jobs(favorites_only, data.get('cursor'), data.get('limit'))
+            except ValueError:
+                await self.send(text_data=json.dumps({
+                    'error': 'Invalid cursor'
+                }))
+                return
             
             # Send directly to requesting client only
             await self.send(text_data=json.dumps({
                 'jobs': jobs,
+                'seq': seq,
+                'next_cursor': next_cursor,
                 'favorites_only': favorites_only  # Include this so frontend knows the context
             }))
+        elif action == 'resync':
+            # The client saw a gap in the sequence numbers of the job updates
+            seq = await self.get_update_sequence()
+            if data.get('seq') == seq:
+                await self.send(text_data=json.dumps({
+                    'seq': seq,
+                    'up_to_date': True,
+                }))
+                return
+
+            seq, jobs, next_cursor = await self.get_user_jobs(limit=data.get('limit'))
+            await self.send(text_data=json.dumps({
+                'jobs': jobs,
+                'seq': seq,
+                'next_cursor': next_cursor,
+                'resync': True,
+            }))
 
     # Receive message from room group
-    async def jobs_update(self, event):
-        jobs = event['jobs']
+    async def job_update(self, event):
+        """Handle individual job updates"""
+        job = event['job']
         
         # Send message to WebSocket
         await self.send(text_data=json.dumps({
-            'jobs': jobs
+            'job': job,
+            'seq': event['seq'],
         }))
 
-    async def job_update(self, event):
-        """Handle individual job updates"""
-        job = event['job']
-        
+    async def section_update(self, event):
+        """Handle a section of a story that got its image or audio"""
+        section = event['section']
+
         # Send message to WebSocket
         await self.send(text_data=json.dumps({
-            'job': job
+            'section': section
         }))
 
     @database_sync_to_async
-    def get_user_jobs(self, favorites_only=False):
+    def get_update_sequence(self):
+        return JobService.get_update_sequence(self.user_id)
+
+    @database_sync_to_async
+    def get_user_jobs(self, favorites_only=False, cursor=None, limit=None):
+        """
+        Return the sequence number together with a page of the jobs of the user and the cursor of
+        the next page. The sequence number is read before the jobs, so every update that is not part
+        of the list has a higher number.
+        """
         try:
             user = User.objects.get(id=self.user_id)
+            seq = JobService.get_update_sequence(user.id)
             
+            # Get all jobs for the user
+            jobs = JobService.get_jobs_for_user(user)
             if favorites_only:
                 # Get only liked stories and their associated jobs
-                liked_stories = user.liked_stories.all()
-                jobs = StoryJob.objects.filter(story__in=liked_stories, story__user=user).order_by('-created_at')
-            else:
-                # Get all jobs for the user
-                jobs = JobService.get_jobs_for_user(user)
+                jobs = jobs.filter(story__likes=user)
                 
-            return [serialize_job(job) for job in jobs]
+            jobs, next_cursor = paginate_newest_first(jobs, cursor=cursor, limit=limit)
+            return seq, [serialize_job(job) for job in jobs], next_cursor
         except User.DoesNotExist:
-            return []
+            return 0, [], None
@@ -0,0 +1,49 @@
+import signal
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.tasks import JobScheduler
+
+class Command(BaseCommand):
+    help = (
+        "Run the story generation workers in this process, separately from the web server. "
+        "SIGTERM or SIGINT stops claiming new jobs and waits for the ones in progress to finish."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--text-workers', type=int, help="Workers generating story text (default: STORY_TEXT_WORKERS)")
+        parser.add_argument('--image-workers', type=int, help="Workers rendering images (default: STORY_IMAGE_WORKERS)")
+        parser.add_argument('--audio-workers', type=int, help="Workers narrating audio (default: STORY_AUDIO_WORKERS)")
+        parser.add_argument(
+            '--drain-timeout', type=float, default=settings.STORY_WORKER_DRAIN_TIMEOUT,
+            help="Seconds to wait for the jobs in progress when stopping, unfinished jobs are put back in the queue",
+        )
+
+    def handle(self, *args, **options):
+        if settings.CHANNEL_LAYERS['default']['BACKEND'] == 'channels.layers.InMemoryChannelLayer':
+            self.stderr.write(self.style.WARNING(
+                "The in-memory channel layer is used, job updates will not reach the web processes. Set REDIS_URL."
+            ))
+
+        worker_counts = {
+            status: options[option]
+            for status, option in (
+                ('generating_story', 'text_workers'),
+                ('generating_image', 'image_workers'),
+                ('generating_audio', 'audio_workers'),
+            )
+            if options[option] is not None
+        }
+        scheduler = JobScheduler(worker_counts=worker_counts)
+
+        stop_requested = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stop_requested.set())
+
+        scheduler.start()
+        self.stdout.write(f"Story workers started as {scheduler.worker_id}")
+
+        stop_requested.wait()
+        self.stdout.write("Stopping, waiting for the jobs in progress to finish")
+        scheduler.stop(timeout=options['drain_timeout'])
+        self.stdout.write("Story workers stopped")
@@ -0,0 +1,108 @@
+import posixpath
+import re
+import uuid
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.urls import reverse
+
+# File extensions for the media types produced by the generation backends
+MEDIA_EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/webp': 'webp',
+    'audio/mpeg': 'mp3',
+    'audio/mp3': 'mp3',
+    'audio/wav': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/ogg': 'ogg',
+}
+
+def get_story_media_storage():
+    """Storage backend for generated story images and audio, configured as 'story_media' in STORAGES"""
+    return storages['story_media']
+
+def story_media_name(story, kind, index, mime_type):
+    """File name of the image or audio of a story section"""
+    extension = MEDIA_EXTENSIONS.get((mime_type or '').split(';')[0].strip(), 'bin')
+    return posixpath.join('stories', str(story.id), f'{kind}_{index}.{extension}')
+
+def save_story_media(story, kind, index, data, mime_type):
+    """
+    Store the raw bytes of a section's image or audio and return the reference kept on the story.
+    """
+    storage = get_story_media_storage()
+    name = story_media_name(story, kind, index, mime_type)
+
+    # Regenerated sections replace the previous file
+    if storage.exists(name):
+        storage.delete(name)
+    name = storage.save(name, ContentFile(data))
+
+    return {
+        'path': name,
+        'mime_type': mime_type,
+        'size': len(data),
+        # Changes whenever the file is replaced, used for cache busting and as ETag
+        'version': uuid.uuid4().hex[:12],
+    }
+
+def delete_story_media(story):
+    """Delete every stored image and audio of a story"""
+    storage = get_story_media_storage()
+    for reference in (story.images or []) + (story.audios or []):
+        if isinstance(reference, dict) and reference.get('path') and storage.exists(reference['path']):
+            storage.delete(reference['path'])
+
+def story_media_url(story, kind, index, reference):
+    """Relative URL the raw image or audio of a story section is served from"""
+    url = reverse(f'story-{kind}', kwargs={'story_id': story.id, 'index': index})
+    if reference.get('version'):
+        url += f'?v={reference["version"]}'
+    return url
+
+def story_media_payload(kind, url, reference):
+    """Description of a section's image or audio as it is sent to the clients"""
+    if not reference:
+        return None
+    return {
+        f'{kind}_url': url,
+        f'{kind}_mime_type': reference.get('mime_type'),
+    }
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_range(range_header, size):
+    """
+    Parse a single byte range of a Range header into an inclusive (start, end) tuple.
+    Returns None if the header should be ignored and raises ValueError if the range is not satisfiable.
+    """
+    match = RANGE_RE.match((range_header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # Suffix range, the last n bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def iter_file_range(media_file, start, length, chunk_size=64 * 1024):
+    """Yield length bytes of an open file starting at start, closing the file at the end"""
+    try:
+        media_file.seek(start)
+        while length > 0:
+            chunk = media_file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        media_file.close()
@@ -0,0 +1,96 @@
+import base64
+import posixpath
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.db import migrations
+
+EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/webp': 'webp',
+    'audio/mpeg': 'mp3',
+    'audio/wav': 'wav',
+    'audio/ogg': 'ogg',
+}
+
+
+def guess_audio_mime_type(data):
+    if data[:4] == b'RIFF':
+        return 'audio/wav'
+    if data[:3] == b'ID3' or data[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return 'audio/mpeg'
+    if data[:4] == b'OggS':
+        return 'audio/ogg'
+    return 'application/octet-stream'
+
+
+def store(storage, story, kind, index, data, mime_type):
+    name = posixpath.join('stories', str(story.id), f'{kind}_{index}.{EXTENSIONS.get(mime_type, "bin")}')
+    if storage.exists(name):
+        storage.delete(name)
+    name = storage.save(name, ContentFile(data))
+    return {'path': name, 'mime_type': mime_type, 'size': len(data)}
+
+
+def move_media_to_storage(apps, schema_editor):
+    Story = apps.get_model('api', 'Story')
+    storage = storages['story_media']
+
+    for story in Story.objects.only('id', 'images', 'audios').iterator(chunk_size=20):
+        images = []
+        for index, image in enumerate(story.images or []):
+            if isinstance(image, dict) and image.get('path'):
+                images.append(image)
+            elif isinstance(image, dict) and image.get('image'):
+                mime_type = image.get('image_mime_type') or 'image/png'
+                images.append(store(storage, story, 'image', index, base64.b64decode(image['image']), mime_type))
+            else:
+                images.append(None)
+
+        audios = []
+        for index, audio in enumerate(story.audios or []):
+            if isinstance(audio, dict) and audio.get('path'):
+                audios.append(audio)
+            elif isinstance(audio, str) and audio:
+                data = base64.b64decode(audio)
+                audios.append(store(storage, story, 'audio', index, data, guess_audio_mime_type(data)))
+            else:
+                audios.append(None)
+
+        story.images = images if story.images is not None else None
+        story.audios = audios if story.audios is not None else None
+        story.save(update_fields=['images', 'audios'])
+
+
+def move_media_to_database(apps, schema_editor):
+    Story = apps.get_model('api', 'Story')
+    storage = storages['story_media']
+
+    def read(reference):
+        with storage.open(reference['path'], 'rb') as media_file:
+            return base64.b64encode(media_file.read()).decode('utf-8')
+
+    for story in Story.objects.only('id', 'images', 'audios').iterator(chunk_size=20):
+        if story.images is not None:
+            story.images = [
+                {'image': read(image), 'image_mime_type': image['mime_type']} if isinstance(image, dict) and image.get('path') else image
+                for image in story.images
+            ]
+        if story.audios is not None:
+            story.audios = [
+                read(audio) if isinstance(audio, dict) and audio.get('path') else audio
+                for audio in story.audios
+            ]
+        story.save(update_fields=['images', 'audios'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_story_audio_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_media_to_storage, move_media_to_database),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_move_story_media_to_storage'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobUpdateSequence',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='job_update_sequence', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
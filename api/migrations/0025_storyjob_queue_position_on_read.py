@@ -0,0 +1,21 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_jobupdatesequence'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='storyjob',
+            name='position',
+        ),
+        migrations.AddIndex(
+            model_name='storyjob',
+            index=models.Index(fields=['status', 'created_at'], name='storyjob_status_created_idx'),
+        ),
+    ]
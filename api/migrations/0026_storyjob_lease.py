@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_storyjob_queue_position_on_read'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storyjob',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='storyjob',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
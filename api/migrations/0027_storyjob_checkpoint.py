@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_storyjob_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storyjob',
+            name='checkpoint',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
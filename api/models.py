@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 import json
 from django.utils import timezone
@@ -15,20 +17,43 @@ class StoryJob(models.Model):
         ('completed', 'Completed'),
         ('failed', 'Failed'),
     )
+    IN_PROGRESS_STATUSES = ('generating_story', 'generating_image', 'generating_audio')
     
     result = models.TextField(blank=True, null=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
-    position = models.IntegerField(default=0)
     story = models.ForeignKey('Story', on_delete=models.CASCADE, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Claim of the worker running the job, as its worker id and a token of the claim, and until when.
+    # The lease is renewed while the worker is alive.
+    lease_owner = models.CharField(max_length=100, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    # Finished stages and their output, a retried or taken over job resumes from here
+    checkpoint = models.JSONField(default=dict, blank=True)
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Queue positions are counted over the queued jobs in creation order
+            models.Index(fields=['status', 'created_at'], name='storyjob_status_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.story.user.username}'s job: {self.story.title} ({self.status})"
 
+    @staticmethod
+    def queued_before(created_at, job_id):
+        """Queued jobs that are ahead of, or are, the job with the given creation time and id"""
+        return StoryJob.objects.filter(status='queued').filter(
+            models.Q(created_at__lt=created_at) | models.Q(created_at=created_at, id__lte=job_id)
+        )
+
+    def get_queue_position(self):
+        """Position of the job in the queue, computed on read so enqueueing never rewrites other rows"""
+        if self.status != 'queued':
+            return 0
+        return StoryJob.queued_before(self.created_at, self.id).count()
+
 
 class Story(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -37,6 +62,7 @@ class Story(models.Model):
     theme = models.CharField(max_length=100, blank=True, null=True)
     characters = models.JSONField(blank=True, null=True)
     text_sections = models.JSONField(blank=True, null=True)
+    # References to the files in the story media storage, one per section
     images = models.JSONField(blank=True, null=True)
     audios = models.JSONField(blank=True, null=True)
     audio_id = models.IntegerField(blank=True, null=True)
@@ -51,6 +77,22 @@ class Story(models.Model):
         return self.title
 
 
+class JobUpdateSequence(models.Model):
+    """Last sequence number of the job updates pushed to a user, used by clients to detect missed updates"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='job_update_sequence')
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user.username}: {self.value}"
+
+
+@receiver(post_delete, sender=Story)
+def delete_story_files(sender, instance, **kwargs):
+    """Remove the generated images and audio of a deleted story from the media storage"""
+    from .media import delete_story_media
+    delete_story_media(instance)
+
+
 class PasswordResetToken(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     token = models.CharField(max_length=6)
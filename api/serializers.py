@@ -29,5 +29,5 @@ class LoginSerializer(serializers.Serializer):
 class StoryJobSerializer(serializers.ModelSerializer):
     class Meta:
         model = StoryJob
-        fields = ['id', 'title', 'description', 'status', 'position', 'created_at', 'updated_at']
-        read_only_fields = ['status', 'position', 'created_at', 'updated_at']
\ No newline at end of file
+        fields = ['id', 'title', 'description', 'status', 'created_at', 'updated_at']
+        read_only_fields = ['status', 'created_at', 'updated_at']
\ No newline at end of file
@@ -1,15 +1,54 @@
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from .models import StoryJob
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Subquery, Value, When
+from django.utils import timezone
+from .models import JobUpdateSequence, Story, StoryJob
 from .utils import serialize_job
 
+# Columns needed to serialize a job in a listing, the large story JSON fields are never loaded
+JOB_LIST_FIELDS = (
+    'id', 'status', 'created_at',
+    'story', 'story__id', 'story__user', 'story__title', 'story__user_description',
+)
+
 class JobService:
     """Service class for job-related operations"""
     
     @staticmethod
     def get_jobs_for_user(user):
-        """Get all jobs for a user"""
-        return StoryJob.objects.filter(story__user=user).order_by('-created_at')
+        """Get all jobs for a user, ready to be serialized with a constant number of queries"""
+        return JobService.for_listing(StoryJob.objects.filter(story__user=user)).order_by('-created_at')
+
+    @staticmethod
+    def for_listing(queryset):
+        """
+        Load the story of every job in the same query, only with the listed columns,
+        and annotate whether the story owner has favorited it and the queue position.
+        """
+        return JobService.with_queue_position(queryset.select_related('story').only(*JOB_LIST_FIELDS)).annotate(
+            favorited=Exists(Story.likes.through.objects.filter(
+                story_id=OuterRef('story_id'),
+                user_id=OuterRef('story__user_id'),
+            )),
+        )
+
+    @staticmethod
+    def with_queue_position(queryset):
+        """Annotate the queue position of every job, counted in the same query instead of once per job"""
+        queued_ahead = StoryJob.queued_before(OuterRef('created_at'), OuterRef('id')).order_by().values('status').annotate(
+            count=Count('id')
+        ).values('count')
+
+        return queryset.annotate(
+            queue_position=Case(
+                When(status='queued', then=Subquery(queued_ahead)),
+                default=Value(0),
+            ),
+        )
     
     @staticmethod
     def get_job_by_id(job_id, user=None):
@@ -20,43 +59,152 @@ class JobService:
         return StoryJob.objects.get(**query)
     
     @staticmethod
-    def update_queue_positions():
-        """Update the position of all queued jobs"""
-        queued_jobs = StoryJob.objects.filter(status='queued').order_by('created_at')
-        
-        # Update positions
-        for i, job in enumerate(queued_jobs):
-            job.position = i + 1
-            job.save(update_fields=['position'])
-    
+    def claimable_jobs():
+        """Queued jobs, and jobs in progress whose worker stopped renewing its lease"""
+        return StoryJob.objects.filter(
+            Q(status='queued') |
+            (Q(status__in=StoryJob.IN_PROGRESS_STATUSES) & (
+                Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=timezone.now())
+            ))
+        )
+
+    @staticmethod
+    def claim_next_job(worker_id):
+        """
+        Lease the oldest claimable job to the worker, move it to 'generating_story' and return it.
+        Databases that support it skip rows locked by other workers, elsewhere a conditional
+        update guarantees that a job is claimed by only one worker.
+        The lease is a token of this claim prefixed with the worker id, so a job that is claimed
+        again by the same worker, e.g. after a retry, does not share the lease of its earlier run.
+        """
+        lease = {
+            'status': 'generating_story',
+            'lease_owner': f'{worker_id}:{uuid.uuid4().hex[:8]}',
+            'lease_expires_at': timezone.now() + timedelta(seconds=settings.STORY_JOB_LEASE_DURATION),
+            'updated_at': timezone.now(),
+        }
+
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                job_id = JobService.claimable_jobs().select_for_update(skip_locked=True).order_by(
+                    'created_at'
+                ).values_list('id', flat=True).first()
+                if job_id is None:
+                    return None
+                StoryJob.objects.filter(id=job_id).update(**lease)
+            return StoryJob.objects.select_related('story', 'story__user').get(id=job_id)
+
+        candidates = JobService.claimable_jobs().order_by('created_at').values_list('id', flat=True)[:10]
+        for job_id in candidates:
+            if JobService.claimable_jobs().filter(id=job_id).update(**lease):
+                return StoryJob.objects.select_related('story', 'story__user').get(id=job_id)
+        return None
+
+    @staticmethod
+    def requeue_failed_job(job_id):
+        """Put a failed job back in the queue, returns whether it was failed and is now queued"""
+        return bool(StoryJob.objects.filter(id=job_id, status='failed').update(
+            status='queued',
+            result=None,
+            lease_owner=None,
+            lease_expires_at=None,
+            updated_at=timezone.now(),
+        ))
+
+    @staticmethod
+    def renew_leases(leases):
+        """Extend the given leases of the jobs that are still running, returns the leases that are still held"""
+        held = StoryJob.objects.filter(
+            lease_owner__in=leases,
+            status__in=StoryJob.IN_PROGRESS_STATUSES,
+        )
+        held.update(lease_expires_at=timezone.now() + timedelta(seconds=settings.STORY_JOB_LEASE_DURATION))
+        return set(held.values_list('lease_owner', flat=True))
+
+    @staticmethod
+    def update_leased_job(job_id, lease, **fields):
+        """Write the fields of a job only while the lease is held on it, returns whether it was"""
+        return bool(StoryJob.objects.filter(id=job_id, lease_owner=lease).update(updated_at=timezone.now(), **fields))
+
+    @staticmethod
+    def update_leased_story(job, lease, **fields):
+        """Write the fields of a job's story only while the lease is held on the job, returns whether it was"""
+        return bool(Story.objects.filter(
+            id=job.story_id,
+            storyjob__id=job.id,
+            storyjob__lease_owner=lease,
+        ).update(**fields))
+
     @staticmethod
-    def send_job_updates(job, send_individual=True):
-        """Send WebSocket notifications about job status changes"""
+    def release_jobs(worker_id):
+        """Put the jobs a stopping worker could not finish back in the queue for the other workers"""
+        return StoryJob.objects.filter(
+            lease_owner__startswith=f'{worker_id}:',
+            status__in=StoryJob.IN_PROGRESS_STATUSES,
+        ).update(status='queued', lease_owner=None, lease_expires_at=None, updated_at=timezone.now())
+
+    @staticmethod
+    def next_update_sequence(user_id):
+        """Atomically increment and return the job update sequence number of a user"""
+        with transaction.atomic():
+            # Writing first takes the row lock right away, on SQLite reading first can fail
+            # with "database is locked" when another worker writes at the same time
+            updated = JobUpdateSequence.objects.filter(user_id=user_id).update(value=F('value') + 1)
+            if not updated:
+                try:
+                    with transaction.atomic():
+                        JobUpdateSequence.objects.create(user_id=user_id, value=1)
+                except IntegrityError:
+                    # Created by another worker in the meantime
+                    JobUpdateSequence.objects.filter(user_id=user_id).update(value=F('value') + 1)
+            return JobUpdateSequence.objects.filter(user_id=user_id).values_list('value', flat=True).get()
+
+    @staticmethod
+    def get_update_sequence(user_id):
+        """Return the sequence number of the last job update pushed to a user"""
+        return JobUpdateSequence.objects.filter(user_id=user_id).values_list('value', flat=True).first() or 0
+
+    @staticmethod
+    def send_job_update(job):
+        """
+        Send a WebSocket notification with only the changed job. Every update carries the
+        next sequence number of the user, so clients that see a gap know they missed one and resync.
+        """
         channel_layer = get_channel_layer()
-        user_id = job.story.user.id
+        user_id = job.story.user_id
         room_group_name = f'jobs_{user_id}'
-        
-        # Get all jobs for this user
-        jobs = JobService.get_jobs_for_user(job.story.user)
-        jobs_data = [serialize_job(j) for j in jobs]
-        
-        # Send full jobs list update
-        async_to_sync(channel_layer.group_send)(
-            room_group_name,
-            {
-                'type': 'jobs_update',
-                'jobs': jobs_data
-            }
-        )
-        
-        # Send individual job update
-        if send_individual:
-            job_data = serialize_job(job)
-            
+
+        with transaction.atomic():
+            # Taking the sequence number locks the user's row until the update is sent. The job is read
+            # again after that, so an update with a higher number never carries an older state of the job.
+            seq = JobService.next_update_sequence(user_id)
+            current = JobService.for_listing(StoryJob.objects.filter(id=job.id)).first()
+
             async_to_sync(channel_layer.group_send)(
                 room_group_name,
                 {
                     'type': 'job_update',
-                    'job': job_data
+                    'job': serialize_job(current or job),
+                    'seq': seq,
                 }
-            )
\ No newline at end of file
+            )
+
+    @staticmethod
+    def send_section_update(job, index, **section_data):
+        """Send a WebSocket notification that a single section of a story has new content"""
+        channel_layer = get_channel_layer()
+        room_group_name = f'jobs_{job.story.user_id}'
+
+        async_to_sync(channel_layer.group_send)(
+            room_group_name,
+            {
+                'type': 'section_update',
+                'section': {
+                    'job_id': job.id,
+                    'story_id': job.story.id,
+                    'index': index,
+                    'text': job.story.text_sections[index],
+                    **section_data,
+                }
+            }
+        )
@@ -1,151 +1,578 @@
-import threading
+import atexit
+import os
 import queue
+import socket
+import threading
 import time
 import traceback
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import close_old_connections, transaction
 from story_generation.generate_text import generate_text
-from story_generation.generate_audio import generate_audio, generate_audio_gtts
+from story_generation.generate_audio import generate_audio_gtts, generate_audios
 from story_generation.generate_image import generate_images, generate_images_gemini, generate_sections_and_image_prompts, split_and_generate_image_prompts
+from .media import save_story_media, story_media_payload, story_media_url
 from .models import StoryJob
 from .services import JobService
-import base64
 
-# Global queue for job processing
-job_queue = queue.Queue()
+class LeaseLost(Exception):
+    """The job is no longer leased to this worker, it was released or taken over by another one"""
 
-# Flag to track if worker is running
-worker_running = False
 
-def process_jobs():
-    """Process jobs from the queue"""
-    global worker_running
-    
-    while not job_queue.empty():
-        job_id = job_queue.get()
-        
-        try:
-            # Get the job from database
-            job = StoryJob.objects.get(id=job_id)
-            
-            # Update job status to generating story
-            job.status = 'generating_story'
-            job.position = 0
-            job.save()
-            
-            # Notify status change
-            JobService.send_job_updates(job, send_individual=True)
-            
-            # Process the job
-            generated_story = generate_text(
-                description=job.story.user_description,
-                theme=job.story.theme,
-                characters=job.story.characters
-            )
-
-            # Get the title
-            lines = generated_story.splitlines()
-            if lines and lines[0].startswith("Title: "):
-                result_title = lines[0][len("Title: "):].strip()
-                generated_story = '\n'.join(lines[1:]).lstrip()
-            else:
-                result_title = ''
-
-            if job.story:
-                job.story.title = result_title
-                job.story.save()
-                
-            # Update job status to generating image
-            job.status = 'generating_image'
-            job.save()
-
-            # Notify status change
-            JobService.send_job_updates(job, send_individual=True)
-            
-            # Get the generated sections and image prompts
-            divide_by_ai = True
-            if divide_by_ai:
-                sections = generate_sections_and_image_prompts(generated_story, theme=job.story.theme)
-            else:
-                sections = split_and_generate_image_prompts(generated_story)
-            model_category = job.story.characters[0].get('source', '')
-            sections = generate_images(sections, model_category)
-
-            story_text_sections = []
-            story_images = []
-            for section in sections:
-                story_text_sections.append(section.get('text', ''))
-                # Convert binary image data to base64 string for JSON serialization
-                image_data = section.get('image')
-                if image_data and isinstance(image_data, bytes):
-                    encoded_image = base64.b64encode(image_data).decode('utf-8')
+def save_story_fields(job, *fields):
+    """
+    Write fields of the job's story, only while the job still has the lease of the claim it was loaded by,
+    so a run that lost the job cannot overwrite the progress of its new owner.
+    """
+    if not JobService.update_leased_story(job, job.lease_owner, **{field: getattr(job.story, field) for field in fields}):
+        raise LeaseLost(f"Story job {job.id} is no longer leased to {job.lease_owner}")
+
+def generate_story_stage(job, state):
+    """Generate the story text and the title, then split it into sections with image prompts"""
+    generated_story = generate_text(
+        description=job.story.user_description,
+        theme=job.story.theme,
+        characters=job.story.characters
+    )
+
+    # Get the title
+    lines = generated_story.splitlines()
+    if lines and lines[0].startswith("Title: "):
+        result_title = lines[0][len("Title: "):].strip()
+        generated_story = '\n'.join(lines[1:]).lstrip()
+    else:
+        result_title = ''
+
+    # Get the generated sections and image prompts
+    divide_by_ai = True
+    if divide_by_ai:
+        sections = generate_sections_and_image_prompts(generated_story, theme=job.story.theme)
+    else:
+        sections = split_and_generate_image_prompts(generated_story)
+
+    story_text_sections = [section.get('text', '') for section in sections]
+
+    if job.story:
+        job.story.title = result_title
+        job.story.text_sections = story_text_sections
+        # Images and audios are filled in one section at a time as they are ready
+        job.story.images = [None] * len(sections)
+        job.story.audios = [None] * len(sections)
+        save_story_fields(job, 'title', 'text_sections', 'images', 'audios')
+
+    state['sections'] = sections
+    state['text_sections'] = story_text_sections
+
+def section_saver(job, kind):
+    """
+    Return a callback that stores a single section's image or audio as soon as it is ready and
+    notifies the client, so the first pages can be shown while the rest is still rendering.
+    The file goes to the story media storage and the story only keeps a reference to it.
+    """
+    field = f'{kind}s'
+    lock = threading.Lock()
+
+    def save_section(index, data, mime_type):
+        reference = save_story_media(job.story, kind, index, data, mime_type) if data else None
+
+        with lock:
+            getattr(job.story, field)[index] = reference
+            save_story_fields(job, field)
+
+        url = story_media_url(job.story, kind, index, reference) if reference else None
+        JobService.send_section_update(job, index, **{kind: story_media_payload(kind, url, reference)})
+
+    return save_section
+
+def missing_sections(job, kind, count):
+    """
+    Indices of the sections that have no image or audio yet. Sections stored by an earlier,
+    failed or interrupted run of the job are kept, so a retry only generates the rest.
+    """
+    field = f'{kind}s'
+    references = getattr(job.story, field)
+    if not isinstance(references, list) or len(references) != count:
+        references = [None] * count
+        setattr(job.story, field, references)
+        save_story_fields(job, field)
+    return [index for index, reference in enumerate(references) if not reference]
+
+def generate_image_stage(job, state):
+    """Render an image for each section that does not have one yet"""
+    model_category = job.story.characters[0].get('source', '')
+    indices = missing_sections(job, 'image', len(state['sections']))
+    save_image = section_saver(job, 'image')
+    generate_images(
+        # Copies, the rendered images are added to the sections and must not end up in the checkpoint
+        [dict(state['sections'][index]) for index in indices],
+        model_category,
+        on_section=lambda i, section: save_image(indices[i], section.get('image'), section.get('image_mime_type')),
+    )
+
+def generate_audio_stage(job, state):
+    """Synthesize the narration for each text section that does not have it yet"""
+    indices = missing_sections(job, 'audio', len(state['text_sections']))
+    save_audio = section_saver(job, 'audio')
+    generate_audios(
+        [state['text_sections'][index] for index in indices],
+        job.story.audio_id,
+        on_section=lambda i, audio: save_audio(indices[i], audio.get('audio'), audio.get('audio_mime_type')),
+    )
+
+# Seconds between the checks of a worker waiting on a stage queue whether the scheduler gave up draining the stage
+STAGE_QUEUE_POLL_INTERVAL = 0.5
+
+# Stage graph keyed on the job status that is shown while the stage runs, with the stages it depends on.
+# Stages are listed in a valid execution order; images and audio only need the sections, so they run side by side.
+STAGES = (
+    ('generating_story', generate_story_stage, ()),
+    ('generating_image', generate_image_stage, ('generating_story',)),
+    ('generating_audio', generate_audio_stage, ('generating_story',)),
+)
+
+
+class PipelineStage:
+    """A generation stage with its own worker threads and a bounded input queue"""
+
+    def __init__(self, status, handler, dependencies, worker_count, queue_size):
+        self.status = status
+        self.handler = handler
+        self.dependencies = dependencies
+        self.worker_count = worker_count
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        # Set once the scheduler stopped waiting for the stage to drain, the runs still headed for it are given up
+        self.closed = threading.Event()
+
+
+class JobRun:
+    """Progress of a single job through the stage graph, restored from the job's checkpoint"""
+
+    def __init__(self, job, stages):
+        self.job = job
+        # Lease of the claim that started the run, every write for the job is checked against it
+        self.lease = job.lease_owner
+        # The stages of the scheduler that claimed the job, kept here so a run outlives a stopped scheduler
+        self.stages = stages
+        checkpoint = job.checkpoint or {}
+        self.state = dict(checkpoint.get('state', {}))
+        self.done = set(checkpoint.get('stages', []))
+        self.failed = False
+        # Set once the job's lease is lost, nothing is written for the job after that
+        self.abandoned = False
+        self.lock = threading.Lock()
+
+    @property
+    def stopped(self):
+        return self.failed or self.abandoned
+
+
+class JobScheduler:
+    """
+    Pipelined executor for story jobs. The first stage claims queued jobs from
+    the StoryJob table and every following stage has its own bounded queue and
+    workers, so text generation for one job overlaps image and audio generation
+    for the jobs ahead of it. A stage is started for a job as soon as all the
+    stages it depends on are done, and the job completes once every stage is.
+    The database is the durable queue. Every claimed job is leased to this
+    scheduler and the lease is renewed while the job runs, so when a worker
+    process dies its jobs are taken over by another one once the lease expires.
+    Every write for a job is conditional on the lease, a run whose lease was
+    lost is abandoned without touching the job again.
+    """
+
+    def __init__(self, stages=STAGES, poll_interval=None, worker_counts=None):
+        self.stage_definitions = stages
+        self.poll_interval = poll_interval
+        self.worker_counts = worker_counts
+        self.worker_id = None
+        self.stages = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._pending = 0
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        # Runs of the claimed jobs by lease, their leases are renewed by the heartbeat
+        self._active = {}
+        self._active_lock = threading.Lock()
+        self._heartbeat = None
+
+    @property
+    def running(self):
+        return bool(self.stages)
+
+    def start(self):
+        """Start the stage workers if they are not running yet"""
+        with self._lock:
+            if self.stages:
+                return
+
+            self._stopping.clear()
+            self._stopped.clear()
+            self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+            worker_counts = {**settings.STORY_STAGE_WORKERS, **(self.worker_counts or {})}
+            for status, handler, dependencies in self.stage_definitions:
+                self.stages.append(PipelineStage(
+                    status,
+                    handler,
+                    dependencies,
+                    worker_count=worker_counts[status],
+                    queue_size=settings.STORY_STAGE_QUEUE_SIZE,
+                ))
+
+            for stage in self.stages:
+                target = self._consume_queue if stage.dependencies else self._claim_jobs
+                for i in range(stage.worker_count):
+                    thread = threading.Thread(target=target, args=(stage,), name=f'{stage.status}-worker-{i + 1}')
+                    thread.daemon = True
+                    thread.start()
+                    stage.threads.append(thread)
+
+            self._heartbeat = threading.Thread(target=self._renew_leases, name='lease-heartbeat')
+            self._heartbeat.daemon = True
+            self._heartbeat.start()
+
+            atexit.register(self.stop)
+
+    def notify(self):
+        """Wake up an idle worker because a job was enqueued"""
+        with self._wakeup:
+            self._pending += 1
+            self._wakeup.notify()
+
+    def stop(self, timeout=None):
+        """
+        Stop claiming new jobs and wait up to timeout seconds for the jobs already in the pipeline to finish.
+        The jobs that are not done by then go back to the queue.
+        """
+        with self._lock:
+            self._stopping.set()
+            with self._wakeup:
+                self._wakeup.notify_all()
+
+            if timeout is None:
+                timeout = settings.STORY_WORKER_DRAIN_TIMEOUT
+            deadline = time.monotonic() + timeout
+
+            # Stages are drained in order, a stage gets its stop markers only once
+            # everything upstream has finished and handed its jobs over
+            for stage in self.stages:
+                if stage.dependencies:
+                    for _ in stage.threads:
+                        try:
+                            stage.queue.put(None, timeout=max(0, deadline - time.monotonic()))
+                        except queue.Full:
+                            break
+                for thread in stage.threads:
+                    thread.join(max(0, deadline - time.monotonic()))
+
+            # Past the deadline the runs still queued for a stage, or waiting for a saturated one, are given up
+            for stage in self.stages:
+                stage.closed.set()
+
+            self._stopped.set()
+            if self._heartbeat:
+                self._heartbeat.join()
+                self._heartbeat = None
+
+            # Jobs that did not finish in time go back to the queue right away instead of waiting for the lease to expire.
+            # Their runs are abandoned first, so the stages still running do not write to them afterwards.
+            with self._active_lock:
+                runs = list(self._active.values())
+                self._active.clear()
+            for run in runs:
+                with run.lock:
+                    run.abandoned = True
+            if self.stages:
+                JobService.release_jobs(self.worker_id)
+                close_old_connections()
+
+            self.stages = []
+            atexit.unregister(self.stop)
+
+    def _claim_jobs(self, stage):
+        poll_interval = self.poll_interval or settings.STORY_WORKER_POLL_INTERVAL
+
+        while not self._stopping.is_set():
+            try:
+                job = JobService.claim_next_job(self.worker_id)
+            except Exception as e:
+                print(f"Failed to claim story job: {e}")
+                job = None
+
+            if job is None:
+                with self._wakeup:
+                    if not self._pending and not self._stopping.is_set():
+                        self._wakeup.wait(poll_interval)
+                    self._pending = max(0, self._pending - 1)
+                continue
+
+            run = JobRun(job, self.stages)
+            with self._active_lock:
+                self._active[run.lease] = run
+
+            with self._handling(run):
+                # Notify status change
+                self._notify(job)
+
+                if stage.status in run.done:
+                    self._resume(run)
                 else:
-                    encoded_image = None
-
-                story_images.append({
-                    'image': encoded_image,
-                    'image_mime_type': section.get('image_mime_type', None),
-                })
-
-            if job.story:
-                job.story.text_sections = story_text_sections
-                job.story.images = story_images
-                job.story.save()
-
-            job.status = 'generating_audio'
-            job.save()
-
-            # Notify status change
-            JobService.send_job_updates(job, send_individual=True)
-
-            # Generate audio from the text
-            result_audios = []
-            for section in story_text_sections:
-                result_audio = generate_audio(section, job.story.audio_id)
-                time.sleep(0.2)
-                result_audios.append(result_audio)
-            
-            # Update the associated story with the generated content and audio
-            if job.story:
-                job.story.audios = result_audios
-                job.story.save()
-            
-            # Update job with result
-            job.status = 'completed'
-            job.save()
-            
-            # Notify status change after completion
-            JobService.send_job_updates(job, send_individual=True)
-            # Update positions for remaining jobs
-            JobService.update_queue_positions()
+                    self._process(stage, run)
+
+        close_old_connections()
+
+    def _renew_leases(self):
+        """Keep renewing the leases of the running jobs until the scheduler has stopped"""
+        interval = settings.STORY_JOB_LEASE_DURATION / 3
+        while not self._stopped.wait(interval):
+            with self._active_lock:
+                leases = list(self._active)
+            if not leases:
+                continue
+            try:
+                renewed = JobService.renew_leases(leases)
+                # A lease that is not held anymore expired and its job was taken over, or the job was retried
+                for lease in set(leases) - renewed:
+                    with self._active_lock:
+                        run = self._active.get(lease)
+                    if run:
+                        self._abandon(run)
+            except Exception as e:
+                print(f"Failed to renew story job leases: {e}")
+            finally:
+                close_old_connections()
+
+    def _consume_queue(self, stage):
+        while True:
+            try:
+                run = stage.queue.get(timeout=STAGE_QUEUE_POLL_INTERVAL)
+            except queue.Empty:
+                if stage.closed.is_set():
+                    break
+                continue
+            if run is None:
+                break
+            if stage.closed.is_set():
+                self._abandon(run, 'the workers stopped before it was done')
+                continue
+            with self._handling(run):
+                self._process(stage, run)
+
+        close_old_connections()
+
+    def _process(self, stage, run):
+        job = run.job
+        try:
+            if run.stopped:
+                return
+
+            self._update_status(run)
+            if run.stopped:
+                return
+            stage.handler(job, run.state)
+
+            with run.lock:
+                if run.stopped:
+                    return
+                run.done.add(stage.status)
+                self._save_checkpoint(run)
+                ready = [
+                    next_stage for next_stage in run.stages
+                    if stage.status in next_stage.dependencies
+                    and all(dependency in run.done for dependency in next_stage.dependencies)
+                ]
+
+            for next_stage in ready:
+                self._hand_over(next_stage, run)
+
+            if not ready:
+                # Shows the stage still running alongside this one, or completes the job if it was the last
+                self._update_status(run)
+        except LeaseLost:
+            self._abandon(run)
         except Exception as e:
-            job.status = 'failed'
-            job.result = str(e) + "\n" + traceback.format_exc()
-            job.position = 0
-            job.save()
-
-            # Notify status change on failure
-            JobService.send_job_updates(job, send_individual=True)
-            # Update positions for remaining jobs
-            JobService.update_queue_positions()
-            raise e
+            self._fail(stage, run, e)
         finally:
-            job_queue.task_done()
-    
-    # No more jobs, worker is no longer running
-    worker_running = False
-
-def add_job_to_queue(job):
-    """Add a job to the processing queue and start worker if needed"""
-    global worker_running
-
-    # Add job to queue
-    job_queue.put(job.id)
-
-    # Update queue positions
-    JobService.update_queue_positions()
-
-    # Start worker thread if not already running
-    if not worker_running:
-        worker_running = True
-        thread = threading.Thread(target=process_jobs)
-        thread.daemon = True
-        thread.start()
+            close_old_connections()
+
+    def _resume(self, run):
+        """Continue a job whose first stages were finished by an earlier run with the stages that are left"""
+        try:
+            ready = [
+                stage for stage in run.stages
+                if stage.status not in run.done
+                and all(dependency in run.done for dependency in stage.dependencies)
+            ]
+            self._update_status(run)
+            if not ready or run.stopped:
+                return
+
+            for stage in ready:
+                self._hand_over(stage, run)
+        except Exception as e:
+            self._fail(run.stages[0], run, e)
+        finally:
+            close_old_connections()
+
+    def _save_checkpoint(self, run):
+        """Persist the finished stages and their output, called with the run lock held"""
+        checkpoint = {
+            'stages': [stage.status for stage in run.stages if stage.status in run.done],
+            'state': run.state,
+        }
+        if not self._write(run, checkpoint=checkpoint):
+            raise LeaseLost(f"Story job {run.job.id} is no longer leased to {run.lease}")
+        run.job.checkpoint = checkpoint
+
+    def _write(self, run, **fields):
+        """
+        Write fields of the job if it still has the lease of the run, called with the run lock held.
+        Otherwise the run is abandoned and False is returned. The lease fields of run.job are kept as
+        they were when the job was claimed, the story writes are checked against them.
+        """
+        if JobService.update_leased_job(run.job.id, run.lease, **fields):
+            return True
+        run.abandoned = True
+        return False
+
+    def _update_status(self, run):
+        """
+        Show the first unfinished stage as the job status, or completed once every stage is done.
+        The status is decided from run.done under the run lock, so when parallel stages finish at
+        the same time only the one that sees every stage done completes the job.
+        """
+        job = run.job
+        with run.lock:
+            if run.stopped:
+                return
+            status = next((stage.status for stage in run.stages if stage.status not in run.done), 'completed')
+            completed = status == 'completed'
+            if job.status == status:
+                return
+            if completed:
+                written = self._write(run, status=status, lease_owner=None, lease_expires_at=None)
+            else:
+                written = self._write(run, status=status)
+            if written:
+                job.status = status
+                if completed:
+                    self._release(run)
+
+        if not written:
+            self._abandon(run)
+            return
+
+        # Notify status change
+        self._notify(job)
+
+    def _fail(self, stage, run, error):
+        job = run.job
+        with run.lock:
+            if run.stopped:
+                return
+            run.failed = True
+            result = str(error) + "\n" + traceback.format_exc()
+            # The lease is kept, so the stages still running for the job can store their sections for a retry.
+            # A failed job is never claimed or renewed and retry_job clears the lease.
+            written = self._write(run, status='failed', result=result)
+            if written:
+                job.status = 'failed'
+                job.result = result
+                self._release(run)
+
+        if not written:
+            self._abandon(run)
+            return
+
+        print(f"Story job {job.id} failed while {stage.status}: {error}")
+        # Notify status change on failure
+        self._notify(job)
+
+    def _notify(self, job):
+        """Send a job update, a failure to send it must not stop the worker or fail the job"""
+        try:
+            JobService.send_job_update(job)
+        except Exception:
+            traceback.print_exc()
+
+    @contextmanager
+    def _handling(self, run):
+        """
+        Stop renewing the lease of a run whose handling raised, for instance because the database went away
+        while its failure was saved, so the job is taken over by another worker once the lease expires
+        instead of being renewed forever. The worker thread carries on with the next job.
+        """
+        try:
+            yield
+        except Exception:
+            self._release(run)
+            traceback.print_exc()
+        except BaseException:
+            self._release(run)
+            raise
+
+    def _hand_over(self, stage, run):
+        """
+        Queue the run for the next stage. Blocks while the stage is saturated, which throttles the stages
+        upstream, unless the scheduler stops waiting for the stage, then the run is given up.
+        """
+        while not stage.closed.is_set():
+            try:
+                stage.queue.put(run, timeout=STAGE_QUEUE_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        self._abandon(run, 'the workers stopped before it was done')
+
+    def _abandon(self, run, reason='it is no longer leased to this worker'):
+        """Give up a run, nothing is written for its job anymore, which belongs to the queue or to another worker now"""
+        with run.lock:
+            run.abandoned = True
+        if self._release(run):
+            print(f"Giving up story job {run.job.id}, {reason}")
+
+    def _release(self, run):
+        """Stop renewing the lease of the run, returns whether it was still active"""
+        with self._active_lock:
+            return self._active.pop(run.lease, None) is not None
+
+
+scheduler = JobScheduler()
+
+def add_job_to_queue(story):
+    """
+    Create a job for the story, add it to the processing queue and start the workers if needed.
+    Returns the job and its queue position, counted in the same transaction that queues the job,
+    so no worker can claim it in between.
+    """
+    with transaction.atomic():
+        job = StoryJob.objects.create(story=story)
+        position = job.get_queue_position()
+        # Wake up a worker once the job is visible to it
+        transaction.on_commit(scheduler.notify)
+
+    # Without in-process workers the job is picked up by a separate run_story_workers process
+    if settings.STORY_WORKERS_IN_PROCESS:
+        scheduler.start()
+    return job, position
+
+def retry_job(job):
+    """
+    Queue a failed job again. It resumes from its checkpoint, so the finished stages and the
+    sections that already have their image or audio are not generated again.
+    Returns False if the job has not failed.
+    """
+    with transaction.atomic():
+        if not JobService.requeue_failed_job(job.id):
+            return False
+        transaction.on_commit(scheduler.notify)
+
+    job.refresh_from_db()
+    JobService.send_job_update(job)
+
+    if settings.STORY_WORKERS_IN_PROCESS:
+        scheduler.start()
+    return True
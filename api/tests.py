@@ -1,3 +1,150 @@
+from unittest import mock
+from django.contrib.auth.models import User
 from django.test import TestCase
+from .models import Story, StoryJob
+from .services import JobService
+from .tasks import STAGES, JobRun, JobScheduler, PipelineStage, save_story_fields
 
-# Create your tests here.
+
+def noop_stage(job, state):
+    pass
+
+
+class JobSchedulerTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='reader', password='password')
+        story = Story.objects.create(user=user, title='Story')
+        self.job = StoryJob.objects.create(story=story, status='generating_story', lease_owner='test-worker:claim')
+
+        # Stage workers are not started, the stages are run directly
+        self.scheduler = JobScheduler()
+        self.scheduler.worker_id = 'test-worker'
+        self.scheduler.stages = [
+            PipelineStage(status, noop_stage, dependencies, worker_count=1, queue_size=10)
+            for status, _, dependencies in STAGES
+        ]
+
+        self.patches = {}
+        for target in ('api.tasks.JobService.send_job_update', 'api.tasks.close_old_connections'):
+            patcher = mock.patch(target)
+            self.patches[target] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_stage(self, status):
+        return next(stage for stage in self.scheduler.stages if stage.status == status)
+
+    def test_parallel_stages_finishing_together_complete_the_job(self):
+        run = JobRun(self.job, self.scheduler.stages)
+        # The image stage has added itself to the finished stages but not updated the status yet
+        run.done.update({'generating_story', 'generating_image'})
+
+        # Meanwhile the audio stage finishes and completes the job
+        self.scheduler._process(self.get_stage('generating_audio'), run)
+        # Then the image stage updates the status
+        self.scheduler._update_status(run)
+
+        self.job.refresh_from_db()
+        self.assertFalse(run.failed)
+        self.assertEqual(self.job.status, 'completed')
+
+    def test_update_status_shows_the_stage_still_running(self):
+        run = JobRun(self.job, self.scheduler.stages)
+        run.done.update({'generating_story', 'generating_audio'})
+
+        self.scheduler._update_status(run)
+
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'generating_image')
+
+    def test_resume_of_a_finished_job_completes_it(self):
+        self.job.checkpoint = {'stages': [status for status, _, _ in STAGES], 'state': {}}
+        self.job.save()
+
+        run = JobRun(self.job, self.scheduler.stages)
+        self.scheduler._resume(run)
+
+        self.job.refresh_from_db()
+        self.assertFalse(run.failed)
+        self.assertEqual(self.job.status, 'completed')
+
+    def test_failed_job_update_does_not_fail_the_job(self):
+        self.patches['api.tasks.JobService.send_job_update'].side_effect = ConnectionError
+        run = JobRun(self.job, self.scheduler.stages)
+        run.done.update({'generating_story', 'generating_image'})
+
+        self.scheduler._process(self.get_stage('generating_audio'), run)
+
+        self.job.refresh_from_db()
+        self.assertFalse(run.failed)
+        self.assertEqual(self.job.status, 'completed')
+
+    def test_run_whose_lease_was_taken_over_writes_nothing(self):
+        StoryJob.objects.filter(id=self.job.id).update(lease_owner='other-worker:claim')
+
+        def rename_story(job, state):
+            job.story.title = 'Overwritten'
+            save_story_fields(job, 'title')
+
+        run = JobRun(self.job, self.scheduler.stages)
+        run.done.add('generating_story')
+        self.scheduler._process(PipelineStage('generating_image', rename_story, ('generating_story',), 1, 10), run)
+
+        self.job.refresh_from_db()
+        self.assertTrue(run.abandoned)
+        self.assertFalse(run.failed)
+        self.assertEqual(self.job.status, 'generating_story')
+        self.assertEqual(self.job.checkpoint, {})
+        self.assertEqual(self.job.story.title, 'Story')
+
+    def test_earlier_run_of_a_job_claimed_again_by_the_same_worker_writes_nothing(self):
+        earlier = JobRun(self.job, self.scheduler.stages)
+        earlier.done.update({'generating_story', 'generating_image'})
+        # The job was retried and claimed again by this scheduler while the earlier run was still going
+        StoryJob.objects.filter(id=self.job.id).update(lease_owner='test-worker:again')
+
+        self.scheduler._process(self.get_stage('generating_audio'), earlier)
+
+        self.job.refresh_from_db()
+        self.assertTrue(earlier.abandoned)
+        self.assertEqual(self.job.status, 'generating_story')
+        self.assertEqual(self.job.checkpoint, {})
+
+    def test_stages_finishing_after_stop_leave_the_released_job_alone(self):
+        run = JobRun(self.job, self.scheduler.stages)
+        run.done.update({'generating_story', 'generating_image'})
+        self.scheduler._active[run.lease] = run
+
+        self.scheduler.stop(timeout=0)
+        # A stage that outlived the drain timeout finishes afterwards
+        self.scheduler._process(run.stages[2], run)
+
+        self.job.refresh_from_db()
+        self.assertTrue(run.abandoned)
+        self.assertFalse(run.failed)
+        self.assertEqual(self.job.status, 'queued')
+        self.assertIsNone(self.job.lease_owner)
+
+
+class JobUpdateTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='reader', password='password')
+        story = Story.objects.create(user=user, title='Story')
+        self.job = StoryJob.objects.create(story=story, status='generating_audio')
+
+        patcher = mock.patch('api.services.get_channel_layer')
+        self.channel_layer = patcher.start().return_value
+        self.channel_layer.group_send = mock.AsyncMock()
+        self.addCleanup(patcher.stop)
+
+    def sent(self):
+        return [call.args[1] for call in self.channel_layer.group_send.call_args_list]
+
+    def test_update_sent_from_a_stale_job_carries_the_current_status(self):
+        # Another stage completed the job after this copy of it was loaded
+        StoryJob.objects.filter(id=self.job.id).update(status='completed')
+        JobService.send_job_update(self.job)
+        JobService.send_job_update(StoryJob.objects.get(id=self.job.id))
+
+        updates = self.sent()
+        self.assertEqual([update['seq'] for update in updates], [1, 2])
+        self.assertEqual([update['job']['status'] for update in updates], ['completed', 'completed'])
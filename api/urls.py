@@ -4,7 +4,7 @@ from .views import (
     UserStoriesView, StoryDetailView, ChangePasswordView,
     ChangeEmailView, RequestPasswordResetView, ConfirmPasswordResetView,
     LikeStoryView, UnlikeStoryView, StoryThemesView, StoryCharactersView,
-    UserAudiosView, UploadAudioView, DownloadAudioView,
+    UserAudiosView, UploadAudioView, DownloadAudioView, StoryMediaView, RetryJobView,
 )
 
 urlpatterns = [
@@ -20,6 +20,9 @@ urlpatterns = [
     path('create-story/', CreateStoryView.as_view(), name='create-story'),
     path('stories/', UserStoriesView.as_view(), name='user-stories'),
     path('story/<int:story_id>/', StoryDetailView.as_view(), name='story-detail'),
+    path('story/<int:story_id>/images/<int:index>/', StoryMediaView.as_view(kind='image'), name='story-image'),
+    path('story/<int:story_id>/audios/<int:index>/', StoryMediaView.as_view(kind='audio'), name='story-audio'),
+    path('retry-job/', RetryJobView.as_view(), name='retry-job'),
     path('like-story/', LikeStoryView.as_view(), name='like-story'),
     path('unlike-story/', UnlikeStoryView.as_view(), name='unlike-story'),
     path('story-themes/', StoryThemesView.as_view(), name='story-themes'),
@@ -1,18 +1,35 @@
+import base64
+from datetime import datetime
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.db.models import Q
 from profanity_check import predict
 
 def serialize_job(job):
     """
-    Centralized function to serialize a job consistently across the application
+    Centralized function to serialize a job consistently across the application.
+    Jobs loaded through JobService.for_listing carry favorited and queue_position annotations,
+    so no extra query is needed.
     """
+    if hasattr(job, 'favorited'):
+        favorited = job.favorited
+    else:
+        favorited = job.story.likes.filter(id=job.story.user_id).exists() if job.story else False
+
+    if hasattr(job, 'queue_position'):
+        position = job.queue_position
+    else:
+        position = job.get_queue_position()
+
     return {
         'job_id': job.id,
         'story_id': job.story.id,
         'title': job.story.title if job.story else 'Untitled Story',
         'status': job.status,
-        'position': job.position if job.status == 'queued' else 0,
+        'position': position,
         'created_at': job.created_at.isoformat(),
         'description': job.story.user_description if job.story else '',
-        'favorited': job.story.user in job.story.likes.all() if job.story else False,
+        'favorited': favorited,
     }
 
 def contains_profanity(text):
@@ -21,4 +38,73 @@ def contains_profanity(text):
     """
     prediction = predict([text])[0]
     
-    return prediction
\ No newline at end of file
+    return prediction
+
+def encode_cursor(created_at, pk):
+    """
+    Encode the position of a row in a (created_at, id) ordered listing as an opaque cursor
+    """
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{pk}'.encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor, raises ValueError if it is malformed
+    """
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def get_page_size(limit):
+    """
+    Clamp a requested page size to the configured bounds
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return settings.LIST_PAGE_SIZE
+    return max(1, min(limit, settings.LIST_MAX_PAGE_SIZE))
+
+def paginate_newest_first(queryset, cursor=None, limit=None):
+    """
+    Keyset pagination over (created_at, id), newest first. Only the rows of the requested page
+    are read, however deep the page is. Returns the rows and the cursor of the next page, or None.
+    """
+    limit = get_page_size(limit)
+    queryset = queryset.order_by('-created_at', '-id')
+
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+
+    return rows, next_cursor
+
+
+class UploadSizeLimitHandler(FileUploadHandler):
+    """
+    Upload handler that stops reading the request as soon as the uploaded files grow past max_size bytes.
+    It has to come before the handler that stores the files.
+    """
+
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size
+        self.received = 0
+        self.exceeded = False
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_size:
+            self.exceeded = True
+            raise StopUpload(connection_reset=True)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
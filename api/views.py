@@ -1,21 +1,30 @@
-import time
 import os
-import requests
 from django.core.mail import send_mail
 from django.conf import settings
 from rest_framework import generics, permissions, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
-from api.models import StoryJob, Story, StoryCharacter, StoryTheme
-from api.tasks import add_job_to_queue
-from api.utils import contains_profanity
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from api.models import Story, StoryCharacter, StoryJob, StoryTheme
+from api.tasks import add_job_to_queue, retry_job
+from api.services import JobService
+from story_generation.http_clients import get_async_client
+from api.media import get_story_media_storage, iter_file_range, parse_range, story_media_payload, story_media_url
+from api.utils import UploadSizeLimitHandler, contains_profanity, paginate_newest_first
 from .serializers import UserSerializer, LoginSerializer
 from django.contrib.auth.models import User
 from .models import PasswordResetToken
 from django.db import models
-from django.http import HttpResponse
-import io
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 # get tts backend url from environment variable
 TTS_BACKEND_URL = os.getenv("TTS_BACKEND_URL", "http://localhost:8080")
@@ -174,42 +183,48 @@ class CreateStoryView(APIView):
             audio_id=audio_id,
         )
 
-        # Create a new job and link it to the story
-        job = StoryJob.objects.create(
-            story=story
-        )
-
-        # Add job to queue
-        add_job_to_queue(job)
-
-        time.sleep(0.1)
-        job.refresh_from_db()
+        # Create a new job for the story and add it to the queue
+        job, position = add_job_to_queue(story)
 
         return Response({
             'job_id': job.id,
             'story_id': story.id,
             'status': job.status,
-            'position': job.position
+            'position': position
         }, status=status.HTTP_201_CREATED)
 
 
 class UserStoriesView(APIView):
     """
-    API endpoint for listing all stories for the current user
+    API endpoint for listing the stories of the current user, newest first.
+    Pages are selected with the cursor and limit query parameters.
     """
     permission_classes = [permissions.IsAuthenticated]
     
     def get(self, request):
-        stories = Story.objects.filter(user=request.user)
+        # Only the listed columns are loaded, never the text, image or audio JSON
+        stories = Story.objects.filter(user=request.user).only('id', 'title', 'user_description', 'created_at')
+
+        try:
+            stories, next_cursor = paginate_newest_first(
+                stories,
+                cursor=request.query_params.get('cursor'),
+                limit=request.query_params.get('limit'),
+            )
+        except ValueError:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
         
         story_list = [{
             'story_id': story.id,
             'title': story.title,
-            'content': story.content,
+            'user_description': story.user_description,
             'created_at': story.created_at,
         } for story in stories]
         
-        return Response(story_list, status=status.HTTP_200_OK)
+        return Response({
+            'results': story_list,
+            'next_cursor': next_cursor,
+        }, status=status.HTTP_200_OK)
 
 
 class StoryDetailView(APIView):
@@ -227,8 +242,14 @@ class StoryDetailView(APIView):
                 'title': story.title,
                 'user_description': story.user_description,
                 'text_sections': story.text_sections,
-                'audios': story.audios,
-                'images': story.images,
+                'audios': [
+                    story_media_payload('audio', request.build_absolute_uri(story_media_url(story, 'audio', index, audio)), audio) if audio else None
+                    for index, audio in enumerate(story.audios or [])
+                ],
+                'images': [
+                    story_media_payload('image', request.build_absolute_uri(story_media_url(story, 'image', index, image)), image) if image else None
+                    for index, image in enumerate(story.images or [])
+                ],
                 'created_at': story.created_at,
                 'favorited': story.likes.filter(id=request.user.id).exists()
             }
@@ -239,92 +260,242 @@ class StoryDetailView(APIView):
             return Response({'error': 'Story not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
-class UserAudiosView(APIView):
+class StoryMediaView(APIView):
     """
-    API endpoint for retrieving all audio files for the current user
+    API endpoint for streaming the raw image or audio of a story section,
+    with support for range requests and conditional requests
     """
-
     permission_classes = [permissions.IsAuthenticated]
-    
-    def get(self, request):
+    kind = None
+
+    # Media is versioned through the URL, so clients may cache it for a long time
+    CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+    def get(self, request, story_id, index):
+        try:
+            story = Story.objects.only('id', 'user', f'{self.kind}s').get(id=story_id, user=request.user)
+        except Story.DoesNotExist:
+            return Response({'error': 'Story not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        references = getattr(story, f'{self.kind}s') or []
+        reference = references[index] if index < len(references) else None
+        if not reference:
+            return Response({'error': 'Media not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        storage = get_story_media_storage()
+        try:
+            size = storage.size(reference['path'])
+        except FileNotFoundError:
+            return Response({'error': 'Media not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            last_modified = int(storage.get_modified_time(reference['path']).timestamp())
+        except NotImplementedError:
+            last_modified = None
+
+        etag = quote_etag(reference.get('version') or f'{size}-{last_modified}')
+        headers = {
+            'ETag': etag,
+            'Cache-Control': self.CACHE_CONTROL,
+            'Accept-Ranges': 'bytes',
+        }
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified)
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            for header, value in headers.items():
+                not_modified[header] = value
+            return not_modified
+
+        content_type = reference.get('mime_type') or 'application/octet-stream'
+
+        # A Range is ignored if If-Range does not match the current version
+        if_range = request.headers.get('If-Range')
+        byte_range = None
+        if not if_range or if_range == etag:
+            try:
+                byte_range = parse_range(request.headers.get('Range'), size)
+            except ValueError:
+                response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        media_file = storage.open(reference['path'], 'rb')
+        if byte_range is None:
+            response = FileResponse(media_file, content_type=content_type)
+            response['Content-Length'] = size
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                iter_file_range(media_file, start, end - start + 1),
+                status=status.HTTP_206_PARTIAL_CONTENT,
+                content_type=content_type,
+            )
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+
+async def stream_backend_response(response):
+    """Yield the raw body of a streamed backend response and release its connection at the end"""
+    try:
+        async for chunk in response.aiter_raw():
+            yield chunk
+    finally:
+        await response.aclose()
+
+class AsyncProxyView(View):
+    """
+    Base class for async endpoints that proxy requests to another backend.
+    DRF views are sync only, so token authentication runs in a thread and the
+    handlers await the backend with a pooled async client instead of holding a worker thread.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token authenticated like the DRF views, which are exempt from CSRF as well
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            credentials = await sync_to_async(TokenAuthentication().authenticate)(request)
+        except AuthenticationFailed as e:
+            return JsonResponse({'detail': str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+        if credentials is None:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        request.user, request.auth = credentials
+        return await super().dispatch(request, *args, **kwargs)
+
+def audio_list_cache_key(user_id):
+    """Cache key of the list of a user's audio files on the TTS backend"""
+    return f'tts_audio_list_{user_id}'
+
+class UserAudiosView(AsyncProxyView):
+    """
+    API endpoint for retrieving all audio files for the current user.
+    The list is cached per user and dropped from the cache when the user uploads a new file.
+    """
+
+    async def get(self, request):
+        cache_key = audio_list_cache_key(request.user.id)
+        audio_files = await cache.aget(cache_key)
+        if audio_files is not None:
+            return JsonResponse(audio_files, status=status.HTTP_200_OK, safe=False)
+
         # Make web request to TTS-Backend
         # set user_id in headers
         headers = {
-            'Authorization': f'Token {request.user.auth_token.key}',
+            'Authorization': f'Token {request.auth.key}',
             'Content-Type': 'application/json',
             'User-Id': str(request.user.id),
         }
-        response = requests.get(f'{TTS_BACKEND_URL}/api/audio-files/getlist', headers=headers)
+        response = await get_async_client('tts').get(f'{TTS_BACKEND_URL}/api/audio-files/getlist', headers=headers)
         if response.status_code == 200:
             audio_files = response.json()
-            return Response(audio_files, status=status.HTTP_200_OK)
+            if settings.TTS_AUDIO_LIST_CACHE_TTL > 0:
+                await cache.aset(cache_key, audio_files, settings.TTS_AUDIO_LIST_CACHE_TTL)
+            return JsonResponse(audio_files, status=status.HTTP_200_OK, safe=False)
         else:
-            return Response({'error': 'Failed to retrieve audio files'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return JsonResponse({'error': 'Failed to retrieve audio files'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class UploadAudioView(APIView):
+class UploadAudioView(AsyncProxyView):
     """
     API endpoint for uploading an audio file
     """
 
-    permission_classes = [permissions.IsAuthenticated]
-    
-    def post(self, request):
+    async def post(self, request):
         # Make web request to TTS-Backend
         # set user_id in headers
         print("Uploading audio file...")
-        print(request.data)
+        max_size = settings.TTS_UPLOAD_MAX_SIZE
+        if int(request.META.get('CONTENT_LENGTH') or 0) > max_size:
+            return JsonResponse({'error': 'Audio file is too large'}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        # The upload is written to a temporary file in chunks and never held in memory,
+        # reading stops as soon as it is larger than allowed
+        size_limit = UploadSizeLimitHandler(request, max_size)
+        request.upload_handlers = [size_limit, TemporaryFileUploadHandler(request)]
+        # Parsing the body reads and writes files, so it runs in a thread instead of blocking the event loop
+        fields, uploaded_file = await sync_to_async(lambda: (request.POST, request.FILES.get('file')))()
+        if size_limit.exceeded:
+            return JsonResponse({'error': 'Audio file is too large'}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if uploaded_file is None:
+            return JsonResponse({'error': 'No audio file provided'}, status=status.HTTP_400_BAD_REQUEST)
+
         data = {
-            'name': request.data.get('name', 'audio_file'),
+            'name': fields.get('name', 'audio_file'),
             'user_id': str(request.user.id),
-            'transcript': request.data.get('transcript', ''),
+            'transcript': fields.get('transcript', ''),
         }
 
+        # httpx sends the multipart body chunk by chunk straight from the temporary file
         files = {
-            'file': request.FILES['file'],
+            'file': (uploaded_file.name, uploaded_file, uploaded_file.content_type),
         }
         
         print(data)
-        response = requests.post(f'{TTS_BACKEND_URL}/api/audio-files/upload/', files=files, data=data)
+        response = await get_async_client('tts').post(f'{TTS_BACKEND_URL}/api/audio-files/upload/', files=files, data=data)
         print(response)
         if response.status_code == 200 or response.status_code == 201:
-            return Response({'success': 'File uploaded'}, status=status.HTTP_200_OK)
+            await cache.adelete(audio_list_cache_key(request.user.id))
+            return JsonResponse({'success': 'File uploaded'}, status=status.HTTP_200_OK)
         else:
-            return Response({'error': 'Failed to upload audio file'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return JsonResponse({'error': 'Failed to upload audio file'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class DownloadAudioView(APIView):
+class DownloadAudioView(AsyncProxyView):
     """
     API endpoint for downloading an audio file
     """
 
-    permission_classes = [permissions.IsAuthenticated]
-    
-    def get(self, request, audio_id):
+    # Response headers of the TTS backend that are passed through to the client
+    FORWARDED_HEADERS = ('Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified')
+
+    async def get(self, request, audio_id):
         # Make web request to TTS-Backend
         headers = {
             'Content-Type': 'application/json',
-            'Audio-File-Id': str(audio_id)
+            'Audio-File-Id': str(audio_id),
+            # The body is passed through unchanged, so Content-Length has to match the raw bytes
+            'Accept-Encoding': 'identity',
         }
-        response = requests.get(f'{TTS_BACKEND_URL}/api/audio-files/download', headers=headers)
-        if response.status_code == 200:
-            # Create a file-like object from the binary content
-            audio_io = io.BytesIO(response.content)
-            
+        for header in ('Range', 'If-Range'):
+            if header in request.headers:
+                headers[header] = request.headers[header]
+
+        client = get_async_client('tts')
+        backend_request = client.build_request('GET', f'{TTS_BACKEND_URL}/api/audio-files/download', headers=headers)
+        response = await client.send(backend_request, stream=True)
+
+        if response.status_code in (200, 206):
             # Get the content type from the response if available, or default to octet-stream
             content_type = response.headers.get('Content-Type', 'application/octet-stream')
             
             # Get the filename from the response if available, or use a default
             filename = response.headers.get('Content-Disposition', '').split('filename=')[-1].strip('"') or f'audio_{audio_id}.mp3'
-            
-            # Return as a file response
-            return HttpResponse(
-                audio_io,
+
+            # Forward the file chunk by chunk as it arrives instead of holding all of it in memory
+            streaming_response = StreamingHttpResponse(
+                stream_backend_response(response),
+                status=response.status_code,
                 content_type=content_type,
                 headers={
                     'Content-Disposition': f'attachment; filename="{filename}"'
                 }
             )
-        else:
-            return Response({'error': 'Failed to download audio file'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            for header in self.FORWARDED_HEADERS:
+                if header in response.headers:
+                    streaming_response[header] = response.headers[header]
+            return streaming_response
+
+        await response.aclose()
+        if response.status_code == 416:
+            return HttpResponse(status=416, headers={'Content-Range': response.headers.get('Content-Range', '')})
+        return JsonResponse({'error': 'Failed to download audio file'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class RequestPasswordResetView(APIView):
     """
@@ -401,6 +572,32 @@ class ConfirmPasswordResetView(APIView):
             return Response({'error': 'Invalid email or token.'}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class RetryJobView(APIView):
+    """
+    API endpoint for retrying a failed story job, it continues where it stopped
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        try:
+            job_id = request.data.get('job_id')
+            if not job_id:
+                return Response({'error': 'Job ID is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+            job = JobService.get_job_by_id(job_id, user=request.user)
+            if not retry_job(job):
+                return Response({'error': 'Only failed jobs can be retried'}, status=status.HTTP_400_BAD_REQUEST)
+
+            return Response({
+                'message': 'Job queued again',
+                'job_id': job.id,
+                'position': job.get_queue_position(),
+            }, status=status.HTTP_200_OK)
+
+        except StoryJob.DoesNotExist:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+
 class LikeStoryView(APIView):
     """
     API endpoint for liking a story
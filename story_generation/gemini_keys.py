@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from collections import deque
+from google import genai
+from google.api_core.exceptions import ResourceExhausted
+from google.genai import types
+from google.genai.errors import APIError
+from story_generation.retry import get_retry_after
+
+# Quota of a single API key within GEMINI_QUOTA_WINDOW seconds
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 10))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv('GEMINI_TOKENS_PER_MINUTE', 250000))
+GEMINI_QUOTA_WINDOW = 60
+# Seconds a key that was rate limited is not used, unless Gemini says how long to wait
+GEMINI_KEY_COOLDOWN = float(os.getenv('GEMINI_KEY_COOLDOWN', 60))
+
+
+def is_rate_limited(error):
+    return isinstance(error, ResourceExhausted) or (isinstance(error, APIError) and error.code == 429)
+
+
+def estimate_tokens(contents):
+    """Rough number of input tokens of a request, about four characters per token"""
+    characters = 0
+    for content in contents or []:
+        for part in content.parts or []:
+            characters += len(part.text or '')
+    return characters // 4 + 1
+
+
+def get_token_count(response):
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', None)
+
+
+class GeminiKey:
+    """An API key with its client and the requests sent with it in the current quota window"""
+
+    def __init__(self, api_key, timeout=None):
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
+        )
+        # [sent at, tokens] of every request within the quota window
+        self.usage = deque()
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+
+    def prune(self, now, window):
+        while self.usage and self.usage[0][0] <= now - window:
+            self.usage.popleft()
+
+    def used_tokens(self):
+        return sum(tokens for _, tokens in self.usage)
+
+
+class GeminiKeyPool:
+    """
+    Spreads Gemini requests over several API keys. Every key tracks the requests and tokens it
+    used in a sliding window, a request goes to the least loaded key that still has quota left
+    and waits only if no key has. A key that is rate limited anyway cools down and the request
+    is sent again with another key. Each key keeps a single client.
+    """
+
+    def __init__(self, api_keys, requests_per_minute=GEMINI_REQUESTS_PER_MINUTE, tokens_per_minute=GEMINI_TOKENS_PER_MINUTE,
+                 window=GEMINI_QUOTA_WINDOW, cooldown=GEMINI_KEY_COOLDOWN, timeout=None):
+        self.keys = [GeminiKey(api_key, timeout) for api_key in api_keys]
+        self.requests_per_minute = max(1, requests_per_minute)
+        self.tokens_per_minute = max(1, tokens_per_minute)
+        self.window = window
+        self.cooldown = cooldown
+        self._condition = threading.Condition()
+
+    def generate_content(self, **kwargs):
+        return self.call(lambda client: client.models.generate_content(**kwargs), estimate_tokens(kwargs.get('contents')))
+
+    def generate_content_stream(self, **kwargs):
+        """Streamed request, the chunks are collected so that a rate limit hit mid-stream is retried as well"""
+        return self.call(lambda client: list(client.models.generate_content_stream(**kwargs)), estimate_tokens(kwargs.get('contents')))
+
+    def call(self, func, estimated_tokens=0):
+        """
+        Call func with the client of the best key. Rate limited requests are sent again with another key,
+        once per key, after that the rate limit error is raised.
+        """
+        if not self.keys:
+            raise ValueError("No Gemini API key is configured, set GENAI_API_KEY_1 to GENAI_API_KEY_5")
+
+        for attempt in range(len(self.keys)):
+            key, entry = self._acquire(estimated_tokens)
+            try:
+                response = func(key.client)
+            except Exception as e:
+                if is_rate_limited(e):
+                    cooldown = get_retry_after(e)
+                    self._release(key, entry, cooldown=self.cooldown if cooldown is None else cooldown)
+                    if attempt < len(self.keys) - 1:
+                        continue
+                else:
+                    self._release(key, entry)
+                raise
+
+            chunks = response if isinstance(response, list) else [response]
+            token_counts = [count for count in map(get_token_count, chunks) if count]
+            self._release(key, entry, tokens=token_counts[-1] if token_counts else None)
+            return response
+
+    def _ready_in(self, key, now, tokens):
+        """Seconds until the key may send a request of the given size"""
+        wait = key.cooldown_until - now
+
+        if len(key.usage) >= self.requests_per_minute:
+            wait = max(wait, key.usage[len(key.usage) - self.requests_per_minute][0] + self.window - now)
+
+        excess = key.used_tokens() + min(tokens, self.tokens_per_minute) - self.tokens_per_minute
+        for sent_at, used in key.usage:
+            if excess <= 0:
+                break
+            excess -= used
+            wait = max(wait, sent_at + self.window - now)
+        return wait
+
+    def _load(self, key):
+        return max(len(key.usage) / self.requests_per_minute, key.used_tokens() / self.tokens_per_minute), key.in_flight
+
+    def _acquire(self, tokens):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                waits = {}
+                for key in self.keys:
+                    key.prune(now, self.window)
+                    waits[key] = self._ready_in(key, now, tokens)
+
+                ready = [key for key in self.keys if waits[key] <= 0]
+                if ready:
+                    key = min(ready, key=self._load)
+                    entry = [now, tokens]
+                    key.usage.append(entry)
+                    key.in_flight += 1
+                    return key, entry
+
+                self._condition.wait(min(waits.values()))
+
+    def _release(self, key, entry, tokens=None, cooldown=None):
+        with self._condition:
+            key.in_flight -= 1
+            if tokens is not None:
+                entry[1] = tokens
+            if cooldown is not None:
+                key.cooldown_until = max(key.cooldown_until, time.monotonic() + cooldown)
+            self._condition.notify_all()
@@ -1,66 +1,99 @@
 from gtts import gTTS
 import os
-import tempfile
-import base64
-import requests
+import io
+from story_generation.http_clients import BACKENDS, get_client
+from concurrent.futures import ThreadPoolExecutor
+from story_generation.rate_limit import RateLimiter
+from story_generation.retry import RetryPolicy
 
 TTS_BACKEND_URL = os.getenv("TTS_BACKEND_URL", "http://localhost:9000")
+# Maximum number of sections of a story synthesized at the same time
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 2))
+# Maximum number of TTS requests per second sent by the whole process, 0 disables the limit
+TTS_RATE_LIMIT = float(os.getenv("TTS_RATE_LIMIT", 5))
+
+TTS_RATE_LIMITER = RateLimiter(TTS_RATE_LIMIT, burst=TTS_CONCURRENCY)
+TTS_RETRY_POLICY = RetryPolicy("TTS", timeout=BACKENDS["tts"]["timeout"])
 
 def generate_audio_gtts(input_text):
 	"""
-	Convert text to speech using Google Text-to-Speech API and return base64 encoded audio data.
+	Convert text to speech using Google Text-to-Speech API and return the audio data.
 	
 	Args:
 		input_text: The text to convert to speech
 			
 	Returns:
-		A dictionary containing the base64 encoded audio data
+		A dictionary containing the raw audio data and its mime type
 	"""
 	if not input_text:
-		return {"audio_data": None, "text": input_text}
+		return {"audio": None, "audio_mime_type": None}
 	
 	try:
-		# Create a temporary file to store the audio
-		with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
-			temp_filename = temp_file.name
-		
-		# Generate the speech
+		# Generate the speech into memory
+		audio_file = io.BytesIO()
 		tts = gTTS(text=input_text, lang='en')
-		tts.save(temp_filename)
-		
-		# Read the audio file and encode it to base64
-		with open(temp_filename, 'rb') as audio_file:
-			audio_data = base64.b64encode(audio_file.read()).decode('utf-8')
-		
-		# Clean up the temporary file
-		os.remove(temp_filename)
+		tts.write_to_fp(audio_file)
 		
-		return audio_data
+		return {"audio": audio_file.getvalue(), "audio_mime_type": "audio/mpeg"}
 	except Exception as e:
 		print(f"Error generating audio: {str(e)}")
-		return {"audio_data": None, "error": str(e)}
+		return {"audio": None, "audio_mime_type": None, "error": str(e)}
 
 def generate_audio(input_text, audio_file_id):
     """
-    Convert text to speech using the specified TTS backend and return base64 encoded audio data.
+    Convert text to speech using the specified TTS backend and return the audio data.
 
     Args:
         input_text: The text to convert to speech
         audio_file_id: The ID of the voice to use for TTS
 
     Returns:
-        The base64 encoded audio data or an error message if the request fails.
+        A dictionary containing the raw audio data and its mime type, generated with gTTS if the request
+        still fails after the retries.
     """
     if not input_text:
-        return {"audio_data": None, "text": input_text}
+        return {"audio": None, "audio_mime_type": None}
 
-    response = requests.post(
-        f"{TTS_BACKEND_URL}/api/text-to-audio/generate/",
-        json={"input_text": input_text, "audio_file_id": audio_file_id}
-    )
+    def request():
+        TTS_RATE_LIMITER.acquire()
+        return get_client("tts").post(
+            f"{TTS_BACKEND_URL}/api/text-to-audio/generate/",
+            json={"input_text": input_text, "audio_file_id": audio_file_id},
+            timeout=TTS_RETRY_POLICY.timeout
+        ).raise_for_status()
 
-    if response.status_code == 200:
-        audio_base64 = base64.b64encode(response.content).decode('utf-8')
-        return audio_base64
-    else:
+    try:
+        response = TTS_RETRY_POLICY.call(request)
+    except Exception as e:
+        print(f"TTS request failed, falling back to gTTS: {e}")
         return generate_audio_gtts(input_text)
+
+    audio_mime_type = response.headers.get('Content-Type', 'application/octet-stream').split(';')[0].strip()
+    return {"audio": response.content, "audio_mime_type": audio_mime_type}
+
+def generate_audios(sections, audio_file_id, max_workers=None, on_section=None):
+    """
+    Convert every text section to speech in parallel, at most max_workers at a time.
+
+    Args:
+        sections: The texts to convert to speech
+        audio_file_id: The ID of the voice to use for TTS
+        max_workers: Maximum number of concurrent TTS requests, defaults to TTS_CONCURRENCY
+        on_section: Optional callback, called with the index and the audio of each section as soon as it is ready
+
+    Returns:
+        The results of generate_audio in the same order as the sections.
+    """
+    if not sections:
+        return []
+
+    max_workers = max(1, min(max_workers or TTS_CONCURRENCY, len(sections)))
+
+    def synthesize(index, section):
+        audio = generate_audio(section, audio_file_id)
+        if on_section:
+            on_section(index, audio)
+        return audio
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tts') as executor:
+        return list(executor.map(synthesize, range(len(sections)), sections))
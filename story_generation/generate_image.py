@@ -1,15 +1,15 @@
 import json
 import os
-from google.api_core.exceptions import ResourceExhausted
-from itertools import cycle
-import time
 from pydantic import BaseModel
 from google import genai
 from google.genai import types
-from google.genai.errors import ClientError
 import base64
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from story_generation.gemini_keys import GeminiKeyPool
+from story_generation.http_clients import get_client
 from story_generation.image_config import *
+from story_generation.image_endpoints import IMAGE_RETRY_POLICY, ImageEndpointPool
+from story_generation.retry import RetryPolicy
 
 GEMINI_API_KEYS = [
     os.getenv("GENAI_API_KEY_5"),
@@ -19,7 +19,18 @@ GEMINI_API_KEYS = [
     os.getenv("GENAI_API_KEY_1"),
 ]
 
-API_KEY_CYCLE = cycle(key for key in GEMINI_API_KEYS if key)
+# Seconds a single Gemini request may take before it is retried
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 120))
+GEMINI_RETRY_POLICY = RetryPolicy('Gemini', timeout=GEMINI_TIMEOUT)
+# Shared by all jobs of the process so the quota used on every key is tracked across stories
+GEMINI_KEY_POOL = GeminiKeyPool([key for key in GEMINI_API_KEYS if key], timeout=GEMINI_TIMEOUT)
+
+# Comma separated list of SD WebUI endpoints, sections are spread over all of them
+IMAGE_GENERATOR_URLS = [url.strip() for url in os.getenv('IMAGE_GENERATOR_URL', '').split(',') if url.strip()]
+# Maximum number of sections of a story that are rendered at the same time
+IMAGE_GENERATOR_CONCURRENCY = int(os.getenv('IMAGE_GENERATOR_CONCURRENCY', max(1, len(IMAGE_GENERATOR_URLS))))
+# Shared by all jobs of the process so the loaded checkpoint of every endpoint is tracked across stories
+IMAGE_ENDPOINT_POOL = ImageEndpointPool(IMAGE_GENERATOR_URLS)
 
 class Section(BaseModel):
     text: str
@@ -29,11 +40,7 @@ def generate_sections_and_image_prompts(generated_story, theme):
     """
     Generate image prompts and sections for the story using the Gemini API.
     """
-    while True:
-        try:
-            client = genai.Client(api_key=next(API_KEY_CYCLE))
-
-            input_message = f"""
+    input_message = f"""
 I will provide you a story, theme and character name and you will seperate this story into meaningful segments and provide me an image prompt for each segment to use in SDXL model.,
 
 Here are the rules:
@@ -55,45 +62,31 @@ Theme: {theme}
 Story:
 {generated_story}"""
 
-            model = "gemini-2.5-flash-preview-04-17"
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=input_message),
-                    ],
-                ),
-            ]
-            generate_content_config = types.GenerateContentConfig(
-                thinking_config = types.ThinkingConfig(
-                    thinking_budget=0,
-                ),
-                response_mime_type="application/json",
-                max_output_tokens=16000,
-                response_schema=list[Section],
-            )
-
-            response = client.models.generate_content(
-                model=model,
-                contents=contents,
-                config=generate_content_config,
-            )
-
-            response_json = json.loads(response.text)
-
-            return response_json
-        except ResourceExhausted:
-            sleep_time = 20
-            print(f"Rate limit exceeded for story: Waiting for {sleep_time} seconds before retrying...")
-            time.sleep(sleep_time)
-        except ClientError as e:
-            if e.code == 429:
-                print("Rate limit exceeded for images.")
-                sleep_time = 20
-                print(f"Rate limit exceeded for images: Waiting for {sleep_time} seconds before retrying...")
-                time.sleep(sleep_time)
-            else:
-                raise e
+    model = "gemini-2.5-flash-preview-04-17"
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=input_message),
+            ],
+        ),
+    ]
+    generate_content_config = types.GenerateContentConfig(
+        thinking_config = types.ThinkingConfig(
+            thinking_budget=0,
+        ),
+        response_mime_type="application/json",
+        max_output_tokens=16000,
+        response_schema=list[Section],
+    )
+
+    response = GEMINI_RETRY_POLICY.call(
+        GEMINI_KEY_POOL.generate_content,
+        model=model,
+        contents=contents,
+        config=generate_content_config,
+    )
+    return json.loads(response.text)
             
 def split_and_generate_image_prompts(generated_story, line_count=10):
     """
@@ -110,11 +103,8 @@ def split_and_generate_image_prompts(generated_story, line_count=10):
     
     # Fill the image prompts using the Gemini API
     for section in sections:
-        while True:
-            try:
-                model = "gemini-2.5-flash-preview-04-17"
-                client = genai.Client(api_key=next(API_KEY_CYCLE))
-                input_message = f"""
+        model = "gemini-2.5-flash-preview-04-17"
+        input_message = f"""
 I will provide you a story and that story's segment and you will generate an image prompt for only the given segment to use in SDXL model.
 Here are the rules:
 1 - do not describe character appearance, directly use its name as reference.
@@ -135,42 +125,29 @@ Story:
 Segment:
 {section['text']}
 """
-                contents = [
-                    types.Content(
-                        role="user",
-                        parts=[
-                            types.Part.from_text(text=input_message),
-                        ],
-                    ),
-                ]
-                generate_content_config = types.GenerateContentConfig(
-                    thinking_config = types.ThinkingConfig(
-                        thinking_budget=0,
-                    ),
-                    response_mime_type="text/plain",
-                    max_output_tokens=16000,
-                )
-                
-
-                response = client.models.generate_content(
-                    model=model,
-                    contents=contents,
-                    config=generate_content_config,
-                )
-                section['image_prompt'] = response.text
-                break
-            except ResourceExhausted:
-                sleep_time = 20
-                print(f"Rate limit exceeded for prompts: Waiting for {sleep_time} seconds before retrying...")
-                time.sleep(sleep_time)
-            except ClientError as e:
-                if e.code == 429:
-                    print("Rate limit exceeded for prompts.")
-                    sleep_time = 20
-                    print(f"Rate limit exceeded for prompts: Waiting for {sleep_time} seconds before retrying...")
-                    time.sleep(sleep_time)
-                else:
-                    raise e
+        contents = [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=input_message),
+                ],
+            ),
+        ]
+        generate_content_config = types.GenerateContentConfig(
+            thinking_config = types.ThinkingConfig(
+                thinking_budget=0,
+            ),
+            response_mime_type="text/plain",
+            max_output_tokens=16000,
+        )
+
+        response = GEMINI_RETRY_POLICY.call(
+            GEMINI_KEY_POOL.generate_content,
+            model=model,
+            contents=contents,
+            config=generate_content_config,
+        )
+        section['image_prompt'] = response.text
 
     return sections
 
@@ -179,119 +156,135 @@ def generate_images_gemini(sections):
     Generate images for the given sections using the Gemini API.
     """
     for section in sections:
-        while True:
-            try:
-                # Initialize the client with API key
-                client = genai.Client(api_key=next(API_KEY_CYCLE))
-                model_name = "gemini-2.0-flash-exp-image-generation"
-
-                # Check if image_prompt exists and is not empty, otherwise use a default prompt
-                image_prompt = section.get('image_prompt', '')
-                if not image_prompt or image_prompt.strip() == '':
-                    # Create a basic prompt from the first couple sentences of the section text
-                    text_preview = section.get('text', '')[:100] + '...' if section.get('text') else ''
-                    image_prompt = f"Create an illustration for a children's story showing: {text_preview}"
-                    # Save the generated prompt back to the section
-                    section['image_prompt'] = image_prompt
-
-                # Create proper request structure with Content and Part objects
-                contents = [
-                    genai.types.Content(
-                        role="user",
-                        parts=[
-                            genai.types.Part.from_text(
-                                text=f"Generate a horizontal 16:9 cartoon style image for the following prompt: {image_prompt}"
-                            ),
-                        ],
+        model_name = "gemini-2.0-flash-exp-image-generation"
+
+        # Check if image_prompt exists and is not empty, otherwise use a default prompt
+        image_prompt = section.get('image_prompt', '')
+        if not image_prompt or image_prompt.strip() == '':
+            # Create a basic prompt from the first couple sentences of the section text
+            text_preview = section.get('text', '')[:100] + '...' if section.get('text') else ''
+            image_prompt = f"Create an illustration for a children's story showing: {text_preview}"
+            # Save the generated prompt back to the section
+            section['image_prompt'] = image_prompt
+
+        # Create proper request structure with Content and Part objects
+        contents = [
+            genai.types.Content(
+                role="user",
+                parts=[
+                    genai.types.Part.from_text(
+                        text=f"Generate a horizontal 16:9 cartoon style image for the following prompt: {image_prompt}"
                     ),
-                ]
-                
-                # Configure generation with proper response modalities
-                generate_content_config = genai.types.GenerateContentConfig(
-                    response_modalities=["image", "text"],
-                    response_mime_type="text/plain",
-                )
-                
-                # Stream the response to handle binary data
-                response_stream = client.models.generate_content_stream(
-                    model=model_name,
-                    contents=contents,
-                    config=generate_content_config,
-                )
-                
-                # Process the stream chunks
-                for chunk in response_stream:
-                    if (
-                        chunk.candidates is None
-                        or chunk.candidates[0].content is None
-                        or chunk.candidates[0].content.parts is None
-                    ):
-                        continue
-                    
-                    # If we have inline data (binary image data)
-                    if chunk.candidates[0].content.parts[0].inline_data:
-                        inline_data = chunk.candidates[0].content.parts[0].inline_data
-                        # Store the binary data directly in the section
-                        section['image'] = inline_data.data
-                        section['image_mime_type'] = inline_data.mime_type
-                break
-
-            except ResourceExhausted:
-                sleep_time = 20
-                print(f"Rate limit exceeded for images: Waiting for {sleep_time} seconds before retrying...")
-                time.sleep(sleep_time)
-            except ClientError as e:
-                print(e.code)
-                if e.code == 429:
-                    print("Rate limit exceeded for images.")
-                    sleep_time = 20
-                    print(f"Rate limit exceeded for images: Waiting for {sleep_time} seconds before retrying...")
-                    time.sleep(sleep_time)
-                else:
-                    raise e
+                ],
+            ),
+        ]
+        
+        # Configure generation with proper response modalities
+        generate_content_config = genai.types.GenerateContentConfig(
+            response_modalities=["image", "text"],
+            response_mime_type="text/plain",
+        )
+        
+        # Stream the response to handle binary data
+        response_stream = GEMINI_RETRY_POLICY.call(
+            GEMINI_KEY_POOL.generate_content_stream,
+            model=model_name,
+            contents=contents,
+            config=generate_content_config,
+        )
+        
+        # Process the stream chunks
+        for chunk in response_stream:
+            if (
+                chunk.candidates is None
+                or chunk.candidates[0].content is None
+                or chunk.candidates[0].content.parts is None
+            ):
+                continue
+            
+            # If we have inline data (binary image data)
+            if chunk.candidates[0].content.parts[0].inline_data:
+                inline_data = chunk.candidates[0].content.parts[0].inline_data
+                # Store the binary data directly in the section
+                section['image'] = inline_data.data
+                section['image_mime_type'] = inline_data.mime_type
 
     return sections
 
-def generate_images(sections, model_category):
-    IMAGE_GENERATOR_URL = os.getenv('IMAGE_GENERATOR_URL')
-    
+def build_txt2img_payload(image_prompt, model_category):
+    """
+    Build the SD WebUI txt2img payload for a section prompt using the settings of the model category.
+    """
     MODEL_CATEGORY = model_category
-    
-    for section in sections:
-        PROMPT = section['image_prompt']
-        NEGATIVE_PROMPT = ""
-        
-        model_payload = {
-            'sd_model_checkpoint': CONFIG_CHECKPOINT[MODEL_CATEGORY]
-        }
-
-        config_payload = {
-            'prompt'              : f'{CONFIG_PROMPT[MODEL_CATEGORY]}, {CONFIG_LORA[MODEL_CATEGORY]}, {PROMPT}',
-            'negative_prompt'     : f'{CONFIG_NEGATIVE_PROMPT[MODEL_CATEGORY]}, {NEGATIVE_PROMPT}',
-
-
-            'sampler_name'        : f'{CONFIG_SAMPLER[MODEL_CATEGORY]}',
-            'scheduler'           : 'Automatic',
-            'steps'               : f'{CONFIG_STEPS[MODEL_CATEGORY]}',
-            'width'               : f'{CONFIG_WIDTH[MODEL_CATEGORY]}',
-            'height'              : f'{CONFIG_HEIGHT[MODEL_CATEGORY]}',
-            'cfg_scale'           : f'{CONFIG_GUIDANCE_SCALE[MODEL_CATEGORY]}',
-            'seed'                : f'{CONFIG_SEED[MODEL_CATEGORY]}',
-
-            'enable_hr'           : False,
-            'hr_upscaler'         : f'{CONFIG_UPSCALER[MODEL_CATEGORY]}',
-            'hr_scale'            : f'{CONFIG_UPSCALE_FACTOR[MODEL_CATEGORY]}',
-            'denoising_strength'  : f'{CONFIG_DENOISING_STRENGTH[MODEL_CATEGORY]}',
-
-            'override_settings' : {
-                'CLIP_stop_at_last_layers' : 2,
-            }
-        }
-
-        requests.post(url=f'{IMAGE_GENERATOR_URL}/sdapi/v1/options', json=model_payload, verify=False)
-        response = requests.post(url=f'{IMAGE_GENERATOR_URL}/sdapi/v1/txt2img', json=config_payload, verify=False).json()
-
-        section['image'] = base64.b64decode(response['images'][0])
-        section['image_mime_type'] = 'image/png'
-        
-    return sections
\ No newline at end of file
+    PROMPT = image_prompt
+    NEGATIVE_PROMPT = ""
+
+    return {
+        'prompt'              : f'{CONFIG_PROMPT[MODEL_CATEGORY]}, {CONFIG_LORA[MODEL_CATEGORY]}, {PROMPT}',
+        'negative_prompt'     : f'{CONFIG_NEGATIVE_PROMPT[MODEL_CATEGORY]}, {NEGATIVE_PROMPT}',
+
+
+        'sampler_name'        : f'{CONFIG_SAMPLER[MODEL_CATEGORY]}',
+        'scheduler'           : 'Automatic',
+        'steps'               : f'{CONFIG_STEPS[MODEL_CATEGORY]}',
+        'width'               : f'{CONFIG_WIDTH[MODEL_CATEGORY]}',
+        'height'              : f'{CONFIG_HEIGHT[MODEL_CATEGORY]}',
+        'cfg_scale'           : f'{CONFIG_GUIDANCE_SCALE[MODEL_CATEGORY]}',
+        'seed'                : f'{CONFIG_SEED[MODEL_CATEGORY]}',
+
+        'enable_hr'           : False,
+        'hr_upscaler'         : f'{CONFIG_UPSCALER[MODEL_CATEGORY]}',
+        'hr_scale'            : f'{CONFIG_UPSCALE_FACTOR[MODEL_CATEGORY]}',
+        'denoising_strength'  : f'{CONFIG_DENOISING_STRENGTH[MODEL_CATEGORY]}',
+
+        # The checkpoint is part of every request, the endpoint may have another one loaded by a different process.
+        # It stays loaded afterwards, so the next request with the same checkpoint does not swap it again.
+        'override_settings' : {
+            'sd_model_checkpoint'      : f'{CONFIG_CHECKPOINT[MODEL_CATEGORY]}',
+            'CLIP_stop_at_last_layers' : 2,
+        },
+        'override_settings_restore_afterwards' : False,
+    }
+
+def generate_image(section, model_category, image_generator_url):
+    """
+    Render the image of a single section on the given SD WebUI endpoint.
+    The endpoint loads the checkpoint of the model category if it has another one.
+    """
+    config_payload = build_txt2img_payload(section['image_prompt'], model_category)
+
+    response = IMAGE_RETRY_POLICY.call(
+        lambda: get_client('image').post(
+            f'{image_generator_url}/sdapi/v1/txt2img', json=config_payload, timeout=IMAGE_RETRY_POLICY.timeout
+        ).raise_for_status()
+    ).json()
+
+    section['image'] = base64.b64decode(response['images'][0])
+    section['image_mime_type'] = 'image/png'
+
+    return section
+
+def generate_images(sections, model_category, max_workers=None, on_section=None):
+    """
+    Generate images for the given sections using the SD WebUI endpoints in IMAGE_GENERATOR_URL.
+    Sections are rendered in parallel, at most max_workers at a time, on the endpoints that
+    last rendered with the checkpoint when possible.
+    If given, on_section(index, section) is called from the rendering thread as soon as a section has its image.
+    The sections are returned in their original order.
+    """
+    if not sections:
+        return sections
+
+    max_workers = max(1, min(max_workers or IMAGE_GENERATOR_CONCURRENCY, len(sections)))
+
+    def render(index, section):
+        with IMAGE_ENDPOINT_POOL.acquire(CONFIG_CHECKPOINT[model_category]) as image_generator_url:
+            section = generate_image(section, model_category, image_generator_url)
+
+        if on_section:
+            on_section(index, section)
+        return section
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sd-render') as executor:
+        futures = [executor.submit(render, index, section) for index, section in enumerate(sections)]
+        return [future.result() for future in futures]
@@ -1,8 +1,10 @@
 import os
 import re
-import requests
+from story_generation.http_clients import BACKENDS, get_client
+from story_generation.retry import RetryPolicy
 
 LLM_CONTAINER_URL = os.getenv("LLM_CONTAINER_URL", "http://localhost:8080")
+LLM_RETRY_POLICY = RetryPolicy("LLM", timeout=BACKENDS["llm"]["timeout"])
 
 def generate_text(description, theme, characters, max_seq_length=5000, temperature=1.0, top_k=50):
     character_name = f"{characters[0]['name']} ({characters[0]['source']})"
@@ -38,14 +40,14 @@ Each character's source is given in parentheses. Use only the provided names in
             ]
         }
         
-        response = requests.post(
-            f"{LLM_CONTAINER_URL}/v1/chat/completions",
-            json=payload
+        response = LLM_RETRY_POLICY.call(
+            lambda: get_client("llm").post(
+                f"{LLM_CONTAINER_URL}/v1/chat/completions",
+                json=payload,
+                timeout=LLM_RETRY_POLICY.timeout
+            ).raise_for_status()
         )
         
-        if response.status_code == 200:
-            return response.json().get("choices")[0].get("message").get("content")
-        else:
-            raise ValueError(f"LLM request failed with status code {response.status_code}")
+        return response.json().get("choices")[0].get("message").get("content")
     except Exception as e:
         raise ValueError(f"Error generating text: {str(e)}")
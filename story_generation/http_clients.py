@@ -0,0 +1,77 @@
+import asyncio
+import atexit
+import os
+import threading
+import weakref
+import httpx
+
+# Connection settings of every backend: request timeout in seconds, maximum number of pooled
+# connections, which also caps the number of concurrent requests, and TLS verification
+BACKENDS = {
+    'llm': {
+        'timeout': float(os.getenv('LLM_TIMEOUT', 600)),
+        'max_connections': int(os.getenv('LLM_MAX_CONNECTIONS', 8)),
+        'verify': True,
+    },
+    'tts': {
+        'timeout': float(os.getenv('TTS_TIMEOUT', 120)),
+        'max_connections': int(os.getenv('TTS_MAX_CONNECTIONS', 16)),
+        'verify': True,
+    },
+    'image': {
+        'timeout': float(os.getenv('IMAGE_GENERATOR_TIMEOUT', 600)),
+        'max_connections': int(os.getenv('IMAGE_GENERATOR_MAX_CONNECTIONS', 16)),
+        # The SD WebUI servers are commonly run with self-signed certificates
+        'verify': False,
+    },
+}
+
+CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', 10))
+
+_lock = threading.Lock()
+_clients = {}
+# Async clients are bound to the event loop they were created in
+_async_clients = weakref.WeakKeyDictionary()
+
+def _client_options(backend):
+    config = BACKENDS[backend]
+    return {
+        # Requests wait for a free connection instead of failing when the pool is exhausted
+        'timeout': httpx.Timeout(config['timeout'], connect=CONNECT_TIMEOUT, pool=None),
+        'limits': httpx.Limits(
+            max_connections=config['max_connections'],
+            max_keepalive_connections=config['max_connections'],
+        ),
+        'verify': config['verify'],
+        'follow_redirects': True,
+    }
+
+def get_client(backend):
+    """
+    Shared, thread-safe client with pooled keep-alive connections for the backend ('llm', 'tts' or 'image')
+    """
+    with _lock:
+        client = _clients.get(backend)
+        if client is None:
+            client = _clients[backend] = httpx.Client(**_client_options(backend))
+        return client
+
+def get_async_client(backend):
+    """
+    Shared async client with pooled keep-alive connections for the backend, for the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(backend)
+        if client is None:
+            client = clients[backend] = httpx.AsyncClient(**_client_options(backend))
+        return client
+
+@atexit.register
+def close_clients():
+    """Close the pooled connections of the sync clients"""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from story_generation.http_clients import BACKENDS
+from story_generation.retry import RetryPolicy
+
+# Maximum number of requests sent to one SD WebUI endpoint at the same time
+IMAGE_GENERATOR_MAX_IN_FLIGHT = int(os.getenv('IMAGE_GENERATOR_MAX_IN_FLIGHT', 1))
+# Seconds a section waits for an endpoint that renders its checkpoint before an idle endpoint is switched over anyway
+IMAGE_GENERATOR_SWAP_WAIT = float(os.getenv('IMAGE_GENERATOR_SWAP_WAIT', 30))
+
+IMAGE_RETRY_POLICY = RetryPolicy('Image generator', timeout=BACKENDS['image']['timeout'])
+
+
+class ImageEndpoint:
+    """A SD WebUI server and the checkpoint this process last rendered with on it"""
+
+    def __init__(self, url):
+        self.url = url
+        self.checkpoint = None
+        self.in_flight = 0
+
+
+class ImageEndpointPool:
+    """
+    Hands out SD WebUI endpoints with checkpoint affinity.
+
+    The pool only routes requests, every txt2img payload names its checkpoint itself, because other
+    processes share the endpoints and may have loaded another one. Every endpoint remembers the
+    checkpoint this process last rendered with on it and a request prefers an endpoint with its
+    checkpoint, so checkpoint swaps stay rare. An idle endpoint is only switched to another checkpoint
+    if no request is waiting for the one it has, or if the request has been waiting for longer than
+    swap_wait seconds.
+    """
+
+    def __init__(self, urls, max_in_flight=IMAGE_GENERATOR_MAX_IN_FLIGHT, swap_wait=IMAGE_GENERATOR_SWAP_WAIT):
+        self.endpoints = [ImageEndpoint(url) for url in urls]
+        self.max_in_flight = max(1, max_in_flight)
+        self.swap_wait = swap_wait
+        self._condition = threading.Condition()
+        self._waiting = Counter()
+
+    @contextmanager
+    def acquire(self, checkpoint):
+        """Reserve an endpoint for a request with the checkpoint and yield its url"""
+        endpoint = self._acquire(checkpoint)
+        try:
+            yield endpoint.url
+        finally:
+            with self._condition:
+                endpoint.in_flight -= 1
+                self._condition.notify_all()
+
+    def _acquire(self, checkpoint):
+        if not self.endpoints:
+            raise ValueError("IMAGE_GENERATOR_URL is not configured")
+
+        deadline = time.monotonic() + self.swap_wait
+        with self._condition:
+            self._waiting[checkpoint] += 1
+            try:
+                while True:
+                    endpoint = self._select(checkpoint, force_swap=time.monotonic() >= deadline)
+                    if endpoint:
+                        break
+                    self._condition.wait(max(0.1, deadline - time.monotonic()))
+            finally:
+                self._waiting[checkpoint] -= 1
+
+            endpoint.in_flight += 1
+            endpoint.checkpoint = checkpoint
+            return endpoint
+
+    def _select(self, checkpoint, force_swap=False):
+        loaded = [
+            endpoint for endpoint in self.endpoints
+            if endpoint.checkpoint == checkpoint and endpoint.in_flight < self.max_in_flight
+        ]
+        if loaded:
+            return min(loaded, key=lambda endpoint: endpoint.in_flight)
+
+        idle = [
+            endpoint for endpoint in self.endpoints
+            if endpoint.in_flight == 0 and (
+                force_swap or endpoint.checkpoint is None or not self._waiting[endpoint.checkpoint]
+            )
+        ]
+        if idle:
+            # Prefer endpoints without a checkpoint, then the ones whose checkpoint is least wanted
+            return min(idle, key=lambda endpoint: (endpoint.checkpoint is not None, self._waiting[endpoint.checkpoint]))
+
+        return None
@@ -0,0 +1,34 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket. acquire() blocks until a request may be sent,
+    allowing at most `rate` requests per second with bursts of up to `burst` requests.
+    A rate of 0 or less disables the limiter.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
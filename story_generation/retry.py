@@ -0,0 +1,102 @@
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import httpx
+from google.api_core.exceptions import ResourceExhausted
+from google.genai.errors import APIError
+
+# Defaults of every retry policy
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 5))
+# Seconds before the first retry, doubled on every following one
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+# Longest wait between two attempts, also caps the wait asked for by Retry-After
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60))
+
+# Status codes of responses that are worth sending again
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    """Whether a failed request may succeed when it is sent again"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(error, httpx.TransportError):
+        # Timeouts, refused and dropped connections
+        return True
+    if isinstance(error, APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return isinstance(error, ResourceExhausted)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, given as seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_after(error):
+    """Seconds the backend asked to wait before the next attempt, if it said so"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return parse_retry_after(error.response.headers.get('Retry-After'))
+
+    if isinstance(error, APIError):
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        if retry_after is not None:
+            return retry_after
+
+        # Gemini sends the wait as RetryInfo in the error details, e.g. "retryDelay": "23s"
+        details = error.details.get('error', error.details) if isinstance(error.details, dict) else {}
+        for detail in details.get('details', []) or []:
+            delay = detail.get('retryDelay') if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith('s'):
+                return parse_retry_after(delay[:-1])
+    return None
+
+
+class RetryPolicy:
+    """
+    Retries a backend call with exponential backoff and full jitter, so concurrent workers that were
+    throttled at the same time do not all come back at once. A Retry-After given by the backend is
+    waited for at least. Errors that are not worth retrying, and the last attempt's error, are raised.
+
+    timeout is the limit of a single attempt in seconds, it has to be passed on to the client by the caller.
+    """
+
+    def __init__(self, name, timeout=None, max_attempts=None, base_delay=None, max_delay=None):
+        self.name = name
+        self.timeout = timeout
+        self.max_attempts = max(1, max_attempts or RETRY_MAX_ATTEMPTS)
+        self.base_delay = RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+
+    def get_delay(self, attempt, retry_after=None):
+        """Seconds to wait after the given failed attempt, counted from 1"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """Call func until it returns, retrying the errors that are retryable"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_attempts or not is_retryable(e):
+                    raise
+                delay = self.get_delay(attempt, get_retry_after(e))
+                error = str(e).splitlines()[0] if str(e) else type(e).__name__
+                print(f"{self.name} request failed ({error}), retrying in {delay:.1f} seconds ({attempt}/{self.max_attempts})")
+                time.sleep(delay)